@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+"""Measures pyvty throughput and latency against simulated devices.
+
+Starts pyvty_sim.py in a child process, so the CPU time reported here is
+pyvty's alone, then runs for each protocol:
+
+    import      cold 'import pyvty' time in fresh interpreters, checked
+                against --import-budget, and whether paramiko got loaded
+    single      one session: commands/s, p50/p99 send() latency,
+                MB/s for one bulk 'show big' and CPU seconds per session
+    concurrent  many sessions through a Fleet, the same figures summed
+                over all of them
+    rename      a configure() that changes the hostname, checked to leave
+                the session on the new prompt rather than timing out
+    stall       a strict session sends a command the device answers only
+                after the echo wait expires, checked to stay in step
+
+    python3 benchmark.py --sessions 50 --commands 200 --lines 200000
+    python3 benchmark.py --latency 0.005 --json results.json
+    python3 benchmark.py --metrics pyvty.prom
+
+--metrics writes the concurrent runs' Fleet metrics, per protocol, as
+JSON or, for a path ending in .prom, Prometheus text.
+
+Compare results before and after a change to update_buffer,
+read_until_regex or the transports to catch regressions.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pyvty
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[int(round(fraction * (len(samples) - 1)))]
+
+
+def format_figures(figures):
+    return '  '.join('{0}={1:.3f}'.format(name, value) if isinstance(value, float)
+        else '{0}={1}'.format(name, value) for name, value in sorted(figures.items()))
+
+
+# The simulator stays silent, echo included, this long before this
+# command, past the 3 second wait send() gives the echo.
+stall_command = 'show stall'
+stall_seconds = 3.5
+
+
+def start_simulator(args):
+    """Starts pyvty_sim.py and returns (process, {protocol: port})."""
+    command = [sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pyvty_sim.py'),
+        '--ssh', '0', '--telnet', '0', '--latency', str(args.latency),
+        '--stall', '{0}={1}'.format(stall_command, stall_seconds)]
+    if args.bandwidth:
+        command.extend(['--bandwidth', str(args.bandwidth)])
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+        universal_newlines=True)
+    ports = {}
+    for line in process.stdout:
+        protocol, port = line.split()
+        ports[protocol] = int(port)
+        if len(ports) == 2:
+            break
+    return process, ports
+
+
+def bench_import(args):
+    """Times 'import pyvty' in fresh interpreters; returns the figures."""
+    script = ('import sys, time; start = time.perf_counter(); import pyvty; '
+        'print(time.perf_counter() - start, "paramiko" in sys.modules)')
+    directory = os.path.dirname(os.path.abspath(__file__))
+    timings = []
+    for attempt in range(args.import_runs):
+        output = subprocess.check_output([sys.executable, '-c', script],
+            cwd=directory, universal_newlines=True)
+        seconds, loaded = output.split()
+        timings.append(float(seconds))
+    return {
+        'median_ms': percentile(timings, 0.5) * 1000,
+        'max_ms': max(timings) * 1000,
+        'budget_ms': args.import_budget * 1000,
+        'paramiko_loaded': loaded == 'True',
+        }
+
+
+def run_commands(terminal, count):
+    """Sends count short commands and returns their latencies."""
+    latencies = []
+    for index in range(count):
+        start_time = time.perf_counter()
+        terminal.send('show clock')
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def bench_single(protocol, port, args):
+    cpu_start = time.process_time()
+    start_time = time.perf_counter()
+    terminal = pyvty.Terminal('127.0.0.1', port=port, protocol=protocol,
+        username='admin', password='admin')
+    connect_time = time.perf_counter() - start_time
+    latencies = run_commands(terminal, args.commands)
+    start_time = time.perf_counter()
+    output = terminal.send('show big {0}'.format(args.lines))
+    bulk_time = time.perf_counter() - start_time
+    terminal.close()
+    bulk_bytes = sum(len(line) + 2 for line in output)
+    return {
+        'connect_s': connect_time,
+        'commands_per_s': len(latencies) / sum(latencies),
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'bulk_mb_per_s': bulk_bytes / bulk_time / 1e6,
+        'cpu_s_per_session': time.process_time() - cpu_start,
+        }
+
+
+def check_rename(protocol, port, args):
+    """Renames the device mid-batch and times the next command."""
+    terminal = pyvty.Terminal('127.0.0.1', port=port, protocol=protocol,
+        username='admin', password='admin', timeout=5)
+    original = terminal.hostname
+    try:
+        results = terminal.configure(['hostname pyvty-check',
+            'interface Gi1/0/1', ' description renamed by benchmark.py'])
+        start_time = time.perf_counter()
+        terminal.send('show clock')
+        next_command = time.perf_counter() - start_time
+        passed = (terminal.hostname == 'pyvty-check' and terminal.prompt_matched
+            and not any(result.error for result in results))
+    finally:
+        terminal.configure(['hostname {0}'.format(original)])
+        terminal.close()
+    return {
+        'passed': passed,
+        'next_command_s': next_command,
+        }
+
+
+def check_stall(protocol, port, args):
+    """Checks a strict session answers the commands after a stalled one."""
+    terminal = pyvty.Terminal('127.0.0.1', port=port, protocol=protocol,
+        username='admin', password='admin', strict=True)
+    try:
+        stalled = terminal.send(stall_command)
+        clock = terminal.send('show clock')
+    finally:
+        terminal.close()
+    return {
+        'passed': (any('Invalid input' in line for line in stalled)
+            and any('UTC' in line for line in clock)),
+        }
+
+
+def bench_concurrent(protocol, port, args):
+    cpu_start = time.process_time()
+    start_time = time.perf_counter()
+    fleet = pyvty.Fleet(['127.0.0.1'] * args.sessions,
+        lambda terminal: run_commands(terminal, args.commands),
+        workers=args.sessions, port=port, protocol=protocol,
+        username='admin', password='admin')
+    latencies = []
+    failures = 0
+    for host, result, exception, elapsed in fleet:
+        if exception is None:
+            latencies.extend(result)
+        else:
+            failures += 1
+    elapsed = time.perf_counter() - start_time
+    args.fleet_metrics[protocol] = fleet.metrics
+    return {
+        'sessions': args.sessions,
+        'failures': failures,
+        'elapsed_s': elapsed,
+        'commands_per_s': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'cpu_s_per_session': (time.process_time() - cpu_start) / args.sessions,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--protocols', default='ssh,telnet')
+    parser.add_argument('--commands', type=int, default=100,
+        help='commands per session')
+    parser.add_argument('--lines', type=int, default=100000,
+        help='lines of bulk output')
+    parser.add_argument('--sessions', type=int, default=20,
+        help='sessions in the concurrent run')
+    parser.add_argument('--latency', type=float, default=0,
+        help='simulated device reply latency in seconds')
+    parser.add_argument('--bandwidth', type=int, default=None,
+        help='simulated device output limit in bytes per second')
+    parser.add_argument('--import-runs', type=int, default=5,
+        help='fresh interpreters to time import pyvty in')
+    parser.add_argument('--import-budget', type=float, default=0.1,
+        help='seconds import pyvty may take before the run fails')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--metrics', help='write the concurrent runs\' metrics to this file')
+    args = parser.parse_args()
+    args.fleet_metrics = {}
+
+    results = {'import': bench_import(args)}
+    print('import  {0}'.format(format_figures(results['import'])))
+    failed = results['import']['median_ms'] > results['import']['budget_ms']
+    if failed:
+        print('import pyvty is over its {0} second budget'.format(args.import_budget))
+
+    process, ports = start_simulator(args)
+    try:
+        for protocol in args.protocols.split(','):
+            results[protocol] = {
+                'single': bench_single(protocol, ports[protocol], args),
+                'concurrent': bench_concurrent(protocol, ports[protocol], args),
+                'rename': check_rename(protocol, ports[protocol], args),
+                'stall': check_stall(protocol, ports[protocol], args),
+                }
+            if not results[protocol]['stall']['passed']:
+                print('{0} strict session fell out of step after a stalled command'
+                    .format(protocol))
+                failed = True
+            if not results[protocol]['rename']['passed']:
+                print('{0} session lost its prompt after a hostname change'
+                    .format(protocol))
+                failed = True
+            for run, figures in sorted(results[protocol].items()):
+                print('{0:<7} {1:<11} {2}'.format(protocol, run,
+                    format_figures(figures)))
+    finally:
+        process.terminate()
+        process.wait()
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
+    if args.metrics:
+        pyvty.write_metrics(args.metrics, args.fleet_metrics, label='protocol')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,11 @@ user = 'admin'
 password = 'password'
 
 host = '10.36.65.227'
-config_file = 'config.txt'  # name of text file containing config commands.
+# Name of text file containing config commands.  Indent the lines inside
+# interface and other blocks, as show running-config does, so that only
+# what the device lacks is sent.  A file with no indented lines is sent
+# whole, line by line, since its blocks cannot be told apart.
+config_file = 'config.txt'
 logfile = 'config_' + host + '.log'  # terminal output will be saved in this file.
 
 
@@ -21,13 +25,19 @@ except IOError as e:
 
 term = pyvty.Terminal(host=host, username=user, password=password, logfile=logfile)
 
-term.send('config term')
+if any(line[:1] in (' ', '\t') for line in commands):
+    # Only the lines missing from the running configuration are sent.
+    results = term.push_config(commands, stop_on_error=True)
+    if not results:
+        print('{0} already has this configuration.'.format(host))
+else:
+    results = term.configure(commands, stop_on_error=True)
 
-for command in commands:
-    results = term.send(command.rstrip())
-    for line in results:
+for result in results:
+    for line in result.output.splitlines():
         print(line.rstrip())
+    if result.error:
+        print('! {0} -> {1}'.format(result.command, result.error))
 
 # term.send('write mem')    ''' save configuration to disk '''
-term.send('end')
 term.write('exit')
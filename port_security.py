@@ -116,17 +116,27 @@ for host in fileinput.input(filelist):
                     interface, interfaces[interface]), file=output_file)
         dual_print('!', file=output_file)
 
-        # Apply configuration to ports. Only sends config is write_config is True.
-        print(term.send('config term', send=write_config))
-        for interface in interfaces:
+        # Apply configuration to ports, skipping lines they already have.
+        # Only sends config if write_config is True.
+        desired = []
+        for interface in sorted(interfaces):
             if interfaces[interface] is None:
-                print(term.send('interface {0}'.format(interface), send=write_config))
-                for command in port_security:
-                    print(term.send(command, send=write_config))
-                print(term.send('exit', send=write_config))
-                print(term.send('!', send=write_config))
-        print(term.send('end', send=write_config))
-        print(term.send('write mem', send=write_config))
+                desired.append('interface {0}'.format(interface))
+                desired.extend(' ' + command for command in port_security)
+        commands = pyvty.diff_config(term.running_config(), desired)
+        if not commands:
+            dual_print('! Port-security already applied.', file=output_file)
+        elif write_config:
+            # Keep going past ports the switch rejects, such as dynamic ports.
+            for result in term.configure(commands, stop_on_error=False):
+                print(result.output.strip())
+                if result.error:
+                    dual_print('! {0} -> {1}'.format(result.command, result.error),
+                        file=output_file)
+            print(term.send('write mem'))
+        else:
+            for command in commands:
+                dual_print(command, file=output_file)
         
         term.close()
         
@@ -9,14 +9,31 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import atexit       # flushes transcripts when the interpreter exits
+import bisect       # files latency samples into histogram buckets
+import codecs       # incremental decoding of terminal output
+import collections
+import contextlib
+import concurrent.futures  # thread pool for running jobs across many hosts
 import datetime
+import errno
+import functools
+import json
+import logging      # debug output and tracing
+import mmap         # maps captured output files
+import os
 import getpass      # handles silent password prompt
-import inspect      # introspection so fuctions can know their name debug mode
-import paramiko     # ssh library
+import gzip         # compresses rotated transcripts
+import hashlib      # digests pooled sessions' passwords
+import importlib    # loads protocol backends on first use
+import io
 import re           # regular expressions
+import selectors    # waits for terminal output to become readable
+import shutil
 import socket       # used to test open tcp ports
+import struct       # packs telnet window size
 import sys          # used to print to std.err
-import telnetlib    # telnet library
+import threading
 import time         # used for time.sleep
 import traceback    # provides exception traceback data
 
@@ -33,38 +50,462 @@ send - "exit" hangs until timeout on ssh (generates EOFError eception on telnet.
 change allow_configuration to diable config
 change configure to use a list (or docstring)
 config from file method
-handle --More-- or banner type config, or "exit" (check if connected?)
+handle banner type config, or "exit" (check if connected?)
 
 """
 
-exceptions = (
-            socket.timeout,
-            socket.error,
+
+
+class LazyModule(object):
+    """Stands in for a module that is imported on first attribute access.
+
+    paramiko and asyncio are slow to import and each is only needed by
+    some sessions, so import pyvty leaves them unloaded until an SSH or
+    asyncio session first uses them.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+    def __repr__(self):
+        return '<LazyModule {0!r} {1}>'.format(self._name,
+            'loaded' if self._module else 'not loaded')
+
+
+asyncio = LazyModule('asyncio')       # event loop driving AsyncTerminal sessions
+paramiko = LazyModule('paramiko')     # ssh library
+inspect = LazyModule('inspect')       # introspection so fuctions can know their name debug mode
+
+
+def __getattr__(name):
+    """Builds pyvty.exceptions when it is looked up.
+
+    The tuple holds paramiko's exception types only once paramiko has
+    been loaded, which is always the case by the time an SSH session can
+    raise one, so catching pyvty.exceptions never forces the import.
+    Look it up in the except clause rather than saving it at import.
+    """
+    if name == 'exceptions':
+        return _exceptions()
+    raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
+
+
+def _exceptions():
+    result = (socket.timeout, socket.error)
+    if 'paramiko' in sys.modules:
+        result += (
             paramiko.BadHostKeyException,
             paramiko.AuthenticationException,
             paramiko.SSHException,
-            UserWarning,
             )
+    return result + (UserWarning,)
+
+
+class PromptTimeout(socket.timeout):
+    """Raised when a wait for the prompt is given up.
+
+    output holds what arrived, and was not yet returned, before giving up.
+    reason is 'idle' when timeout seconds passed with no output at all,
+    'deadline' when the session's deadline passed, or 'cancelled' when
+    its CancelToken was cancelled.
+    """
+
+    def __init__(self, message, output=u'', reason='idle'):
+        socket.timeout.__init__(self, message)
+        self.output = output
+        self.reason = reason
+
+
+class ConnectionLost(socket.error):
+    """Raised when the device closes the session while output is awaited.
+
+    output holds what arrived before the session closed.
+    """
+
+    def __init__(self, message, output=u''):
+        socket.error.__init__(self, message)
+        self.output = output
+
+
+class CancelToken(object):
+    """Lets any thread cancel the waits of the sessions it was given to.
+
+        token = pyvty.CancelToken()
+        terminal = pyvty.Terminal(host, cancel=token, ...)
+        ...
+        token.cancel()      # from another thread
+
+    The session's current or next wait then raises PromptTimeout with
+    reason 'cancelled' within poll_interval seconds.  One token may be
+    shared by many sessions to stop them all at once.
+    """
+
+    poll_interval = 0.05
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
 
 debug_level = 0
 
+log = logging.getLogger('pyvty')
+trace_log = logging.getLogger('pyvty.trace')
+
 
 def debug_display_info(debug=0, message=None):
     """Prints current time and current method if debug=1.
     Also prints stack introspection when debug=2.
+
+    pyvty itself logs through the 'pyvty' logger; this is kept for
+    scripts that call it, and does no work when debug is 0.
     """
-    called_from = inspect.stack()[1][3]
-    if debug > 0:
-        if message is None:
-            print("\n=== epoch: {0} === method: {1} ===".format(
-                time.time(), called_from), file=sys.stderr)
-        else:
-            print('[{0}] {1}'.format(called_from, message), file=sys.stderr)
+    if not debug:
+        return
+    called_from = sys._getframe(1).f_code.co_name
+    if message is None:
+        print("\n=== epoch: {0} === method: {1} ===".format(
+            time.time(), called_from), file=sys.stderr)
+    else:
+        print('[{0}] {1}'.format(called_from, message), file=sys.stderr)
     if debug > 1:
         for line in inspect.stack()[1:]:
             print(line, file=sys.stderr)
 
 
+def enable_debug(debug=1):
+    """Sends pyvty debug logging to stderr.
+
+    debug=1 logs at DEBUG level; debug=2 also logs span timings from
+    the 'pyvty.trace' logger.  debug=0 turns debug logging back off.
+    Applications that configure logging themselves can skip this and
+    set the level of the 'pyvty' logger directly.
+    """
+    global debug_level
+    debug_level = debug
+    if debug and not any(getattr(handler, 'pyvty_debug', False)
+            for handler in log.handlers):
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter(
+            '%(asctime)s [%(funcName)s] %(message)s'))
+        handler.pyvty_debug = True
+        log.addHandler(handler)
+    if debug:
+        log.setLevel(logging.DEBUG)
+    else:
+        log.setLevel(logging.NOTSET)
+    if debug > 1:
+        trace_log.setLevel(logging.DEBUG)
+    elif debug:
+        trace_log.setLevel(logging.INFO)
+    else:
+        trace_log.setLevel(logging.NOTSET)
+
+
+class NullSpan(object):
+    """Stands in for a span when tracing is off: entering it costs nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+null_span = NullSpan()
+
+
+class Span(object):
+    """Times one phase of a session and reports it to a Tracer, Metrics or both."""
+
+    def __init__(self, tracer, name, detail, metrics=None):
+        self.tracer = tracer
+        self.name = name
+        self.detail = detail
+        self.metrics = metrics
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.time() - self.start
+        if self.tracer is not None:
+            self.tracer.record(self.name, self.start, duration, self.detail)
+        if self.metrics is not None:
+            self.metrics.observe(self.name, duration)
+        return False
+
+
+class Tracer(object):
+    """Records how long each phase of a session takes.
+
+    Pass trace=True, or a Tracer shared by several sessions, to Terminal
+    to record spans for connect, login, enable, send, batch, prompt_wait,
+    capture, put_file and read.
+    stats() sums them per name; the most recent spans are kept in spans
+    as (name, start, duration, detail) tuples, and each span is also
+    logged to the 'pyvty.trace' logger at DEBUG level.
+    """
+
+    def __init__(self, keep=10000):
+        self.spans = collections.deque(maxlen=keep)
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def span(self, name, detail=None):
+        return Span(self, name, detail)
+
+    def record(self, name, start, duration, detail=None):
+        with self.lock:
+            self.spans.append((name, start, duration, detail))
+            count, total, longest = self.totals.get(name, (0, 0.0, 0.0))
+            self.totals[name] = (count + 1, total + duration, max(longest, duration))
+        if trace_log.isEnabledFor(logging.DEBUG):
+            trace_log.debug('%s %.6f %r', name, duration, detail)
+
+    def stats(self):
+        """Returns {name: {'count', 'total', 'max', 'mean'}} in seconds."""
+        with self.lock:
+            return dict((name, {
+                    'count': count,
+                    'total': total,
+                    'max': longest,
+                    'mean': total / count,
+                    }) for name, (count, total, longest) in self.totals.items())
+
+
+# Upper bounds, in seconds, of the buckets every Histogram counts into.
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram(object):
+    """Counts durations into the fixed latency_buckets.
+
+    Every Histogram has the same buckets, so histograms from many sessions
+    add up exactly, and quantiles are estimated from the bucket counts
+    much as Prometheus does.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(latency_buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(latency_buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, fraction):
+        """Estimates the duration below which fraction of them fall.
+
+        Interpolates within the bucket holding that rank; the open-ended
+        last bucket reports the longest duration seen.
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if index == len(latency_buckets):
+                    return self.max
+                lower = latency_buckets[index - 1] if index else 0.0
+                upper = min(latency_buckets[index], self.max)
+                return lower + (upper - lower) * max(0.0, rank - seen) / count
+            seen += count
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': list(latency_buckets),
+            'counts': list(self.counts),
+            }
+
+
+class Metrics(object):
+    """Counters and latency histograms for one session, or many merged.
+
+    Every Terminal keeps one in its metrics attribute, unless built with
+    metrics=False, or with a Metrics of its own to continue.  Histograms
+    are named after the phases a Tracer records: connect (for ssh this
+    includes key exchange and authentication), login (telnet
+    authentication), enable, send (whole-command latency), batch,
+    prompt_wait, capture and put_file.  Counters:
+
+        connects, reconnects    sessions opened, and opened again
+        bytes_in, bytes_out     raw bytes read from and written to the device
+        wait_seconds            time blocked waiting for output
+        receive_seconds         time decoding and buffering output
+        idle_timeouts           waits that saw no output for timeout seconds
+        deadlines, cancellations
+                                waits ended by a deadline or a CancelToken
+        connections_lost        sessions the device closed during a wait
+        pages                   pager prompts answered
+
+    Updates are not locked, as each session is used from one thread at a
+    time; merge() sessions' Metrics together, as Fleet does, rather than
+    share one between threads.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def add(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def merge(self, other):
+        """Adds the counts of another Metrics into this one."""
+        for name, value in other.counters.items():
+            self.add(name, value)
+        for name, histogram in other.histograms.items():
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].merge(histogram)
+        return self
+
+    def as_dict(self):
+        """Returns the counters and histograms ready for json.dump."""
+        return {
+            'counters': dict(self.counters),
+            'histograms': dict((name, histogram.as_dict())
+                for name, histogram in self.histograms.items()),
+            }
+
+    def prometheus(self, prefix='pyvty', labels=None):
+        """Returns the metrics in the Prometheus text exposition format."""
+        key = tuple(sorted(labels.items())) if labels else None
+        return format_prometheus({key: self}, prefix)
+
+
+def _prometheus_labels(labels, extra=()):
+    labels = tuple(labels or ()) + tuple(extra)
+    if not labels:
+        return u''
+    return u'{{{0}}}'.format(u','.join(u'{0}="{1}"'.format(name,
+        str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels))
+
+
+def _prometheus_number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def format_prometheus(metrics, prefix='pyvty', label='host'):
+    """Formats Metrics in the Prometheus text exposition format.
+
+    metrics is a Metrics, or a dict mapping label values, such as host
+    names, to Metrics; each of those becomes a series labelled
+    label="value".  Counters become <prefix>_<name>_total and histograms
+    <prefix>_<name>_seconds.
+    """
+    if isinstance(metrics, Metrics):
+        metrics = {None: metrics}
+    series = []
+    for key, session in sorted(metrics.items(), key=lambda item: str(item[0])):
+        if key is None:
+            labels = ()
+        elif isinstance(key, tuple):
+            labels = key
+        else:
+            labels = ((label, key),)
+        series.append((labels, session))
+    lines = []
+    for name in sorted(set(name for labels, session in series
+            for name in session.counters)):
+        metric = '{0}_{1}_total'.format(prefix, name)
+        lines.append(u'# TYPE {0} counter'.format(metric))
+        for labels, session in series:
+            if name in session.counters:
+                lines.append(u'{0}{1} {2}'.format(metric,
+                    _prometheus_labels(labels),
+                    _prometheus_number(session.counters[name])))
+    for name in sorted(set(name for labels, session in series
+            for name in session.histograms)):
+        metric = '{0}_{1}_seconds'.format(prefix, name)
+        lines.append(u'# TYPE {0} histogram'.format(metric))
+        for labels, session in series:
+            histogram = session.histograms.get(name)
+            if histogram is None:
+                continue
+            cumulative = 0
+            for bound, count in zip(latency_buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(u'{0}_bucket{1} {2}'.format(metric,
+                    _prometheus_labels(labels, (('le', bound),)), cumulative))
+            lines.append(u'{0}_sum{1} {2!r}'.format(metric,
+                _prometheus_labels(labels), histogram.sum))
+            lines.append(u'{0}_count{1} {2}'.format(metric,
+                _prometheus_labels(labels), histogram.count))
+    return u'\n'.join(lines) + u'\n'
+
+
+def write_metrics(path, metrics, format=None, prefix='pyvty', label='host'):
+    """Writes Metrics, or a dict of them by host, to a file.
+
+    format is 'json' or 'prometheus'; by default a path ending in .prom
+    gets the Prometheus text format, for node_exporter's textfile
+    collector, and anything else JSON.  label names the Prometheus label
+    that the dict keys become.  The file is replaced atomically,
+    so a collector never reads it half written.
+    """
+    if format is None:
+        format = 'prometheus' if path.endswith('.prom') else 'json'
+    if format == 'prometheus':
+        text = format_prometheus(metrics, prefix, label)
+    elif format == 'json':
+        if isinstance(metrics, Metrics):
+            data = metrics.as_dict()
+        else:
+            data = dict((str(key), value.as_dict()) for key, value in metrics.items())
+        text = json.dumps(data, indent=2, sort_keys=True) + '\n'
+    else:
+        raise ValueError('Unknown metrics format {0!r}.'.format(format))
+    temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+    with io.open(temporary, 'w', encoding='utf-8') as metrics_file:
+        metrics_file.write(text)
+    os.replace(temporary, path)
+
+
 def dual_print(*args, **kwargs):
     '''Prints to screen and to file.
     Specify a file handle using 'file=filehandle'.
@@ -106,21 +547,21 @@ def iface_short_name(interface):
     return ''.join(iface_regex.findall(interface))
 
 
-def tcp_is_open(ip, tcp_port):
-    global debug_level
-    debug_display_info(debug=debug_level)
-    debug_display_info(debug=debug_level, message=(ip, str(tcp_port)))
+def tcp_is_open(ip, tcp_port, timeout=1.5):
+    log.debug('probing %s port %s', ip, tcp_port)
     connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     remote_socket = (ip, int(tcp_port))
     try:
-        connection.settimeout(1.5)
+        connection.settimeout(timeout)
         connection.connect(remote_socket)
         connection.shutdown(2)
-        debug_display_info(debug=debug_level, message='returns True')
+        log.debug('%s port %s is open', ip, tcp_port)
         return True
     except:
-        debug_display_info(debug=debug_level, message='returns False')
+        log.debug('%s port %s is closed', ip, tcp_port)
         return False
+    finally:
+        connection.close()
 
 
 def timestamp():
@@ -131,19 +572,23 @@ def filestamp():
     return timestamp().split('.')[0].replace(' ', '_').replace(':', '.')
 
 
+host_cache = {}
+
 def validate_host(host):
-    global debug_level
-    debug_display_info(debug=debug_level)
-    # ipaddress.ip_address(socket.gethostbyname('panther'))
-    #ipaddress.ip_address('host')
-    #print socket.gethostbyname('localhost') # result from hosts file
-    #print socket.getaddrinfo('google.com', 80)
-    return host
+    """Resolves host to an IP address string, caching the result.
+
+    Raises socket.gaierror if the name does not resolve.
+    """
+    if not isinstance(host, str) or not host:
+        raise TypeError('host must be a hostname or IP address string.')
+    address = host_cache.get(host)
+    if address is None:
+        address = socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)[0][4][0]
+        host_cache[host] = address
+    return address
 
 
 def validate_port(port):
-    global debug_level
-    debug_display_info(debug=debug_level)
     try:
         port = int(port)
     except TypeError:
@@ -157,21 +602,26 @@ def validate_port(port):
 
 
 def validate_protocol(protocol):
-    global debug_level
-    debug_display_info(debug=debug_level)
     valid_protocols = ['ssh', 'telnet']
     if protocol is None:
         return None
     try:
         protocol = protocol.lower()
-    except TypeError:
+    except AttributeError:
         raise TypeError('protocol must be one of these {0}.'
             .format(str(valid_protocols)))
+    if protocol not in valid_protocols:
+        raise ValueError('protocol must be one of these {0}.'
+            .format(str(valid_protocols)))
+    return protocol
 
 
-def determine_protocol(host, protocol=None, port=None):
-    global debug_level
-    debug_display_info(debug=debug_level)
+def determine_protocol(host, protocol=None, port=None, cache=None):
+    """Returns (protocol, port) for host, probing ports 22 and 23 if needed.
+
+    With a ReachabilityCache, a fresh entry for host is used instead of
+    probing, and a successful probe is saved to it.
+    """
     port = validate_port(port)
     protocol = validate_protocol(protocol)
     if protocol is None:
@@ -179,283 +629,1612 @@ def determine_protocol(host, protocol=None, port=None):
     if port is None:
         port = {'ssh' : 22, 'telnet' : 23}.get(protocol)
     if port is None:
-        if tcp_is_open(host, 22):
-            port, protocol = (22, 'ssh')
-        elif tcp_is_open(host, 23):
-            port, protocol = (23, 'telnet')
+        entry = cache.get(host) if cache is not None else None
+        if entry is None:
+            entry = discover([host], cache=cache)[host]
+        port, protocol = (entry.port, entry.protocol)
     return (protocol, port)
 
 
-class Terminal(object):
-    """Provides common methods to access a terminal using multiple protocols.
+Reachability = collections.namedtuple('Reachability',
+    ['host', 'address', 'protocol', 'port', 'rtt', 'last_seen'])
 
-    Provides common methods to child classes.
-    Child classes will provide primitive methods for connection setup,
-    send, read, and connection close, which are unique to each implementation.
-    The methods provided here leverage primitive methods to provide
-    compex, common methods.  The child classes will inherit this logic.
+discovery_ports = ((22, 'ssh'), (23, 'telnet'))
+
+
+def _resolve(host):
+    try:
+        return validate_host(host)
+    except (socket.error, TypeError) as exception:
+        log.debug('cannot resolve %s: %s', host, exception)
+        return None
+
+
+def discover(hosts, timeout=1.5, limit=512, workers=64, cache=None):
+    """Finds the protocol and port to reach each of many hosts.
+
+    Names are resolved by a pool of workers threads, then ports 22 and 23
+    of every host are probed at once with non-blocking connects, at most
+    limit sockets at a time, each given timeout seconds.  SSH is preferred
+    when both are open.  Returns a dict of host to Reachability(host,
+    address, protocol, port, rtt, last_seen); protocol, port and rtt are
+    None for hosts that did not answer.  Reachable hosts are saved to
+    cache, a ReachabilityCache, if given.
+    """
+    hosts = list(hosts)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        addresses = dict(zip(hosts, executor.map(_resolve, hosts)))
+    probes = collections.deque(
+        (host, port) for host in hosts if addresses[host]
+        for port, protocol in discovery_ports)
+    rtts = {}
+    selector = selectors.DefaultSelector()
+    try:
+        while probes or selector.get_map():
+            while probes and len(selector.get_map()) < limit:
+                host, port = probes.popleft()
+                address = addresses[host]
+                family = socket.AF_INET6 if ':' in address else socket.AF_INET
+                connection = socket.socket(family, socket.SOCK_STREAM)
+                connection.setblocking(False)
+                error = connection.connect_ex((address, port))
+                if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    connection.close()
+                    continue
+                selector.register(connection, selectors.EVENT_WRITE,
+                    (host, port, time.time()))
+            if not selector.get_map():
+                # Every probe just started failed at once.
+                continue
+            end_time = min(key.data[2] for key in selector.get_map().values()) \
+                + timeout
+            for key, mask in selector.select(max(end_time - time.time(), 0)):
+                host, port, start_time = key.data
+                if not key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                    rtts[(host, port)] = time.time() - start_time
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+            now = time.time()
+            for key in list(selector.get_map().values()):
+                if now - key.data[2] >= timeout:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+    results = {}
+    now = time.time()
+    for host in hosts:
+        results[host] = Reachability(host, addresses[host], None, None, None, None)
+        for port, protocol in discovery_ports:
+            if (host, port) in rtts:
+                results[host] = Reachability(host, addresses[host], protocol,
+                    port, rtts[(host, port)], now)
+                log.debug('%s reachable by %s in %.3fs', host, protocol,
+                    rtts[(host, port)])
+                break
+    if cache is not None:
+        cache.update(result for result in results.values() if result.protocol)
+    return results
+
+
+class ReachabilityCache(object):
+    """Remembers how hosts were reached, in a JSON file, for ttl seconds.
+
+    Terminal reads it through the reachability keyword argument, so
+    repeated runs connect without probing:
+
+        cache = pyvty.ReachabilityCache('~/.pyvty_hosts.json')
+        pyvty.discover(hosts, cache=cache)
+        terminal = pyvty.Terminal(host, reachability=cache, ...)
+    """
+
+    def __init__(self, filename, ttl=86400):
+        self.filename = os.path.expanduser(filename)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        try:
+            with open(self.filename, encoding='utf-8') as cache_file:
+                for host, entry in json.load(cache_file).items():
+                    self.entries[host] = Reachability(host, *entry)
+        except (IOError, ValueError, TypeError) as exception:
+            log.debug('reachability cache not loaded: %s', exception)
+
+    def get(self, host):
+        """Returns the Reachability for host, or None if absent or stale."""
+        entry = self.entries.get(host)
+        if entry is None or time.time() - entry.last_seen > self.ttl:
+            return None
+        return entry
+
+    def update(self, entries):
+        """Adds Reachability entries and saves the file."""
+        with self.lock:
+            for entry in entries:
+                self.entries[entry.host] = entry
+            self._save()
+
+    def discard(self, host):
+        """Forgets host, for example after connecting with its entry fails."""
+        with self.lock:
+            if self.entries.pop(host, None) is not None:
+                self._save()
+
+    def _save(self):
+        now = time.time()
+        data = dict((host, list(entry[1:])) for host, entry in self.entries.items()
+            if now - entry.last_seen <= self.ttl)
+        temporary = '{0}.{1}.tmp'.format(self.filename, os.getpid())
+        with open(temporary, 'w', encoding='utf-8') as cache_file:
+            json.dump(data, cache_file)
+        os.replace(temporary, self.filename)
+
+
+def open_transcript(filename, mode='r'):
+    """Opens a transcript, decompressing rotated .gz and .zst files."""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 't', encoding='utf-8')
+    if filename.endswith('.zst'):
+        import zstandard    # optional: only needed for zstd transcripts
+        stream = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'))
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    return open(filename, mode, encoding='utf-8')
+
+
+def read_transcript(filename):
+    """Yields (epoch, direction, text) from a transcript in records format."""
+    with open_transcript(filename) as transcript:
+        for line in transcript:
+            epoch, direction, text = line.rstrip('\n').split('\t', 2)
+            yield float(epoch), direction, json.loads('"' + text + '"')
+
+
+class TranscriptWriter(object):
+    """Writes a session transcript from a background thread.
+
+    write() only appends the record to an in-memory queue; one shared
+    thread flushes every open writer to its file every flush_interval
+    seconds, so slow disks never stall reads from the device.
+
+    format='text' writes terminal output as it was received, as the
+    original logfile did.  format='records' writes one line per record:
+        <epoch seconds>\t<direction>\t<JSON-escaped text>
+    with direction '<' for output, '>' for input and '#' for comments,
+    which read_transcript() parses back.
+
+    max_bytes and interval rotate the file by size or by age in seconds.
+    Rotated files are renamed with a timestamp and, with compress='gzip'
+    or compress='zstd' (needs the zstandard package), compressed.
+    queue_size bounds the records waiting to be written; once full,
+    policy='block' makes write() wait and policy='drop' discards the
+    record and counts it in dropped.
+    """
+
+    flush_interval = 0.5
+    writers = set()
+    writers_lock = threading.Lock()
+    wakeup = threading.Event()
+    flusher = None
+
+    def __init__(self, filename, mode='a', format='text', max_bytes=None,
+            interval=None, compress=None, queue_size=10000, policy='block'):
+        if format not in ('text', 'records'):
+            raise ValueError("format must be 'text' or 'records'")
+        if compress not in (None, 'gzip', 'zstd'):
+            raise ValueError("compress must be None, 'gzip' or 'zstd'")
+        if policy not in ('block', 'drop'):
+            raise ValueError("policy must be 'block' or 'drop'")
+        if compress == 'zstd':
+            import zstandard    # optional: fail now rather than at rotation
+        self.filename = filename
+        self.format = format
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.compress = compress
+        self.queue_size = queue_size
+        self.policy = policy
+        self.dropped = 0
+        self.records = collections.deque()
+        self.condition = threading.Condition()
+        self.file_lock = threading.Lock()
+        self.file = open(filename, mode, encoding='utf-8')
+        self.size = self.file.tell()
+        self.opened = time.time()
+        with TranscriptWriter.writers_lock:
+            TranscriptWriter.writers.add(self)
+            if TranscriptWriter.flusher is None:
+                TranscriptWriter.flusher = threading.Thread(
+                    target=TranscriptWriter._flush_all, name='pyvty-transcript')
+                TranscriptWriter.flusher.daemon = True
+                TranscriptWriter.flusher.start()
+
+    @classmethod
+    def _flush_all(cls):
+        while True:
+            cls.wakeup.wait(cls.flush_interval)
+            cls.wakeup.clear()
+            with cls.writers_lock:
+                writers = list(cls.writers)
+            for writer in writers:
+                try:
+                    writer.flush()
+                except Exception as exception:
+                    print('transcript_flush_exception: {0}'.format(exception),
+                        file=sys.stderr)
+
+    @classmethod
+    def close_all(cls):
+        """Flushes and closes every open writer."""
+        with cls.writers_lock:
+            writers = list(cls.writers)
+        for writer in writers:
+            writer.close()
+
+    def write(self, text, direction='<'):
+        """Queues text for the transcript.  Returns False if it was dropped."""
+        if self.format == 'text' and direction == '>':
+            # Input shows up in the transcript as the device's echo.
+            return True
+        with self.condition:
+            while len(self.records) >= self.queue_size:
+                if self.policy == 'drop':
+                    self.dropped += 1
+                    return False
+                TranscriptWriter.wakeup.set()
+                self.condition.wait()
+            self.records.append((time.time(), direction, text))
+        return True
+
+    def _format(self, records):
+        if self.format == 'text':
+            return u''.join(text for epoch, direction, text in records)
+        return u''.join(u'{0:.6f}\t{1}\t{2}\n'.format(
+                epoch, direction, json.dumps(text, ensure_ascii=False)[1:-1])
+            for epoch, direction, text in records)
+
+    def flush(self):
+        """Writes queued records to the file, rotating it first if due."""
+        with self.condition:
+            records, self.records = self.records, collections.deque()
+            self.condition.notify_all()
+        with self.file_lock:
+            if self.file is None:
+                return
+            if records:
+                output = self._format(records)
+                self.file.write(output)
+                self.size += len(output)
+            self.file.flush()
+            if (self.max_bytes and self.size >= self.max_bytes
+                    or self.interval and time.time() - self.opened >= self.interval):
+                self.rotate()
+
+    def rotate(self):
+        """Closes the current file, moves it aside and starts a new one."""
+        self.file.close()
+        rotated = '{0}.{1}'.format(self.filename, filestamp())
+        count = 1
+        while os.path.exists(rotated) or os.path.exists(rotated + '.gz') \
+                or os.path.exists(rotated + '.zst'):
+            rotated = '{0}.{1}.{2}'.format(self.filename, filestamp(), count)
+            count += 1
+        os.rename(self.filename, rotated)
+        if self.compress == 'gzip':
+            with open(rotated, 'rb') as source:
+                with gzip.open(rotated + '.gz', 'wb') as target:
+                    shutil.copyfileobj(source, target)
+            os.remove(rotated)
+        elif self.compress == 'zstd':
+            import zstandard
+            with open(rotated, 'rb') as source:
+                with open(rotated + '.zst', 'wb') as target:
+                    zstandard.ZstdCompressor().copy_stream(source, target)
+            os.remove(rotated)
+        self.file = open(self.filename, 'w', encoding='utf-8')
+        self.size = 0
+        self.opened = time.time()
+
+    def close(self):
+        with TranscriptWriter.writers_lock:
+            TranscriptWriter.writers.discard(self)
+        self.flush()
+        with self.file_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+atexit.register(TranscriptWriter.close_all)
+
+
+BatchResult = collections.namedtuple('BatchResult', ['command', 'output', 'error'])
+
+ExecResult = collections.namedtuple('ExecResult',
+    ['command', 'output', 'status', 'error'])
+
+CaptureResult = collections.namedtuple('CaptureResult', ['path', 'size', 'data'])
+
+DeployResult = collections.namedtuple('DeployResult',
+    ['path', 'size', 'output', 'errors'])
+
+regex_cache = {}
+
+
+def compile_regex(pattern, flags=re.MULTILINE):
+    """Returns a compiled regex, compiling each pattern only once."""
+    try:
+        return regex_cache[(pattern, flags)]
+    except KeyError:
+        regex = regex_cache[(pattern, flags)] = re.compile(pattern, flags)
+        return regex
+
+
+class ReceiveBuffer(object):
+    """Accumulates terminal output as a list of chunks.
+
+    Appending a chunk is constant time; the chunks are only joined when the
+    whole text is needed.  tail() hands back just the recent output, so a
+    search for a prompt can skip text that has already been scanned.
+    Holds either str or bytes, matching the type of the initial text.
+    """
+
+    def __init__(self, text=u''):
+        self.empty = text[:0]
+        self.chunks = [text] if text else []
+        self.length = len(text)
+
+    def __len__(self):
+        return self.length
+
+    def append(self, data):
+        self.chunks.append(data)
+        self.length += len(data)
+
+    def text(self):
+        """Returns the whole buffer as one string."""
+        if len(self.chunks) > 1:
+            self.chunks = [self.empty.join(self.chunks)]
+        if self.chunks:
+            return self.chunks[0]
+        return self.empty
+
+    def tail(self, start):
+        """Returns (offset, text) where text runs from offset to the end.
+
+        offset is the start of the chunk holding position start, so text
+        always covers everything from start onwards.
+        """
+        collected = []
+        offset = self.length
+        for chunk in reversed(self.chunks):
+            if offset <= start:
+                break
+            offset -= len(chunk)
+            collected.append(chunk)
+        collected.reverse()
+        return offset, self.empty.join(collected)
+
+    def clear(self):
+        self.chunks = []
+        self.length = 0
+
+    def split(self, position):
+        """Removes and returns the text before position."""
+        text = self.text()
+        remainder = text[position:]
+        self.chunks = [remainder] if remainder else []
+        self.length = len(remainder)
+        return text[:position]
+
+    def truncate(self, position):
+        """Removes the text from position onwards."""
+        while self.chunks and self.length - len(self.chunks[-1]) >= position:
+            self.length -= len(self.chunks.pop())
+        if self.length > position:
+            last = self.chunks[-1]
+            self.chunks[-1] = last[:len(last) - (self.length - position)]
+            self.length = position
+
+
+class ConfigBlock(object):
+    """A configuration line and the block of lines indented beneath it.
+
+    parse_config() returns a root block, with no line, whose children are
+    the top-level configuration lines.  Children keep their order and are
+    looked up by their text:
+
+        config = terminal.running_config()
+        if 'shutdown' in config['interface GigabitEthernet1/0/1']:
+            ...
+    """
+
+    def __init__(self, line=None):
+        self.line = line
+        self.children = collections.OrderedDict()
+
+    def __contains__(self, line):
+        return line in self.children
+
+    def __getitem__(self, line):
+        return self.children[line]
+
+    def __iter__(self):
+        return iter(self.children.values())
+
+    def __len__(self):
+        return len(self.children)
+
+    def __str__(self):
+        return u'\n'.join(self.lines())
+
+    def add(self, line):
+        """Returns the child block for line, adding it if it is new."""
+        child = self.children.get(line)
+        if child is None:
+            child = self.children[line] = ConfigBlock(line)
+        return child
+
+    def find(self, pattern):
+        """Returns the child blocks whose line matches a regex."""
+        regex = compile_regex(pattern)
+        return [child for child in self if regex.search(child.line)]
+
+    def lines(self, indent=u' ', depth=0):
+        """Yields the block's lines indented by depth, as in running-config."""
+        if self.line is not None:
+            for line in self.line.split(u'\n'):
+                yield indent * depth + line
+            depth += 1
+        for child in self:
+            for line in child.lines(indent, depth):
+                yield line
+
+
+def parse_config(config):
+    """Parses configuration text, or a list of lines, into a ConfigBlock.
+
+    Indentation gives the nesting, as in show running-config.  Blank
+    lines, '!' comments, 'end' and the 'Building configuration' header
+    are skipped.  A multi-line banner is kept whole as one line.
+    """
+    if isinstance(config, ConfigBlock):
+        return config
+    if isinstance(config, str):
+        config = config.splitlines()
+    root = ConfigBlock()
+    stack = [(-1, root)]
+    banner = None
+    for line in config:
+        line = line.rstrip(u'\r\n')
+        if banner is not None:
+            banner_lines.append(line)
+            if banner in line:
+                stack[-1][1].add(u'\n'.join(banner_lines))
+                banner = None
+            continue
+        stripped = line.strip()
+        if not stripped or stripped.startswith(u'!') or stripped == u'end' \
+                or line.startswith((u'Building configuration', u'Current configuration')):
+            continue
+        depth = len(line) - len(line.lstrip())
+        while stack[-1][0] >= depth:
+            stack.pop()
+        words = stripped.split()
+        if words[0] == u'banner' and len(words) > 2:
+            delimiter = words[2][:2] if words[2].startswith(u'^') else words[2][0]
+            text = stripped.split(None, 2)[2][len(delimiter):]
+            if delimiter not in text:
+                banner = delimiter
+                banner_lines = [stripped]
+                continue
+        stack.append((depth, stack[-1][1].add(stripped)))
+    return root
+
+
+# Lines that are off unless configured, so 'no x' is in effect while x
+# is absent.  Features on by default never show in the running
+# configuration, so for any other line 'no x' is only known to be in
+# effect when the running configuration shows it.
+default_off = (u'shutdown',)
+
+
+def _negate(line):
+    if line.startswith(u'no '):
+        return line[3:]
+    return u'no ' + line
+
+
+def _diff_block(running, desired, remove, depth, commands):
+    indent = u' ' * depth
+    for block in desired:
+        line = block.line
+        if line.startswith(u'no ') and not len(block):
+            if line in running or (line[3:] in default_off
+                    and line[3:] not in running):
+                continue
+            commands.append(indent + line)
+            continue
+        present = line in running
+        nested = []
+        if len(block):
+            _diff_block(running[line] if present else ConfigBlock(), block,
+                remove, depth + 1, nested)
+        if present and not nested:
+            continue
+        commands.extend(indent + part for part in line.split(u'\n'))
+        if len(block):
+            commands.extend(nested)
+            commands.append(indent + u' exit')
+    if remove and depth > 0:
+        for block in running:
+            if block.line not in desired and _negate(block.line) not in desired:
+                commands.append(indent + _negate(block.line))
+
+
+def diff_config(running, desired, remove=False):
+    """Returns the configuration commands that bring running up to desired.
+
+    Both may be ConfigBlock trees, text or lists of lines.  Lines already
+    present are skipped, and blocks are entered only to add what they
+    lack, then left with 'exit'.  A desired 'no x' line is skipped only
+    when running shows it, or for x in default_off, while x is absent;
+    resending a 'no' is harmless, dropping one is not.  With remove, lines inside a desired block
+    that the block does not list are negated with 'no'; top-level lines
+    missing from desired are always left alone, so desired can be just
+    the sections to manage.
+    """
+    commands = []
+    _diff_block(parse_config(running), parse_config(desired), remove, 0, commands)
+    return commands
+
+
+class TimingProfile(object):
+    """Learns how quickly a device answers and derives a Terminal's delays.
+
+    rtt is the smoothed time from a write to the first output after it and
+    gap the smoothed pause between chunks of one response, both estimated
+    the way TCP estimates round-trip time.  rate is the bytes per second
+    seen within responses.  send_delay, the pause after each write, and
+    idle_timeout, the quiet time after which output is taken as complete,
+    follow from these within the min/max bounds.  Until min_samples round
+    trips are measured the defaults apply.
+
+    as_dict() returns the learned values so a later session can be seeded
+    with them, through TimingProfile(**values) or the timing keyword
+    argument of Terminal.
+    """
+
+    def __init__(self, rtt=None, rtt_var=None, gap=None, rate=None, samples=0,
+            min_send_delay=0.0, max_send_delay=0.5, min_idle=0.02, max_idle=2.0,
+            default_send_delay=0.1, default_idle=0.1, min_samples=3):
+        self.rtt = rtt
+        self.rtt_var = rtt_var
+        self.gap = gap
+        self.rate = rate
+        self.samples = samples
+        self.min_send_delay = min_send_delay
+        self.max_send_delay = max_send_delay
+        self.min_idle = min_idle
+        self.max_idle = max_idle
+        self.default_send_delay = default_send_delay
+        self.default_idle = default_idle
+        self.min_samples = min_samples
+        self.sent_time = None
+        self.response_start = None
+        self.response_bytes = 0
+        self.last_received = None
+
+    def __repr__(self):
+        return 'TimingProfile({0})'.format(', '.join('{0}={1!r}'.format(*item)
+            for item in sorted(self.as_dict().items())))
+
+    def as_dict(self):
+        """Returns the learned values, suitable for json.dump."""
+        return {
+            'rtt': self.rtt,
+            'rtt_var': self.rtt_var,
+            'gap': self.gap,
+            'rate': self.rate,
+            'samples': self.samples,
+            }
+
+    @property
+    def learned(self):
+        return self.samples >= self.min_samples
+
+    @property
+    def send_delay(self):
+        if not self.learned:
+            return self.default_send_delay
+        return min(self.max_send_delay, max(self.min_send_delay, self.rtt / 2))
+
+    @property
+    def idle_timeout(self):
+        if not self.learned:
+            return self.default_idle
+        idle = max(self.rtt + 4 * self.rtt_var, 4 * (self.gap or 0))
+        return min(self.max_idle, max(self.min_idle, idle))
+
+    def sent(self, now=None):
+        """Notes that input was written, starting a round trip."""
+        self.sent_time = now or time.time()
+
+    def replied(self, now=None):
+        """Notes that output after a write is waiting to be read."""
+        now = now or time.time()
+        if self.sent_time is not None:
+            self._rtt_sample(now - self.sent_time)
+            self.sent_time = None
+            self.response_start = now
+            self.response_bytes = 0
+            self.last_received = None
+
+    def received(self, size, now=None):
+        """Notes size bytes of output arriving."""
+        now = now or time.time()
+        if self.sent_time is not None:
+            self.replied(now)
+        elif self.last_received is not None:
+            pause = now - self.last_received
+            if pause < self.max_idle:
+                self.gap = pause if self.gap is None else \
+                    self.gap + (pause - self.gap) / 8
+        self.last_received = now
+        self.response_bytes += size
+        if self.response_start is not None and now - self.response_start > 0.01:
+            rate = self.response_bytes / (now - self.response_start)
+            self.rate = rate if self.rate is None else \
+                self.rate + (rate - self.rate) / 8
+
+    def _rtt_sample(self, sample):
+        if self.rtt is None:
+            self.rtt = sample
+            self.rtt_var = sample / 2
+        else:
+            self.rtt_var += (abs(self.rtt - sample) - self.rtt_var) / 4
+            self.rtt += (sample - self.rtt) / 8
+        self.samples += 1
+
+
+drivers = {}
+
+def register_driver(driver, *names):
+    """Makes a Driver subclass available as Terminal(platform=name).
+
+    The driver is registered under its own name and any extra names.
+    Returns the driver, so this also works as a class decorator.
+    """
+    for name in (driver.name,) + names:
+        drivers[name] = driver
+    return driver
+
+
+def get_driver(platform):
+    """Returns a Driver instance for a platform name, class or instance.
+
+    Unregistered names get the generic Driver, which sends no enable or
+    paging commands, as every platform but 'cisco' once did.
+    """
+    if isinstance(platform, Driver):
+        return platform
+    if isinstance(platform, type) and issubclass(platform, Driver):
+        return platform()
+    try:
+        return drivers[platform.lower()]()
+    except (KeyError, AttributeError):
+        log.warning('no driver for platform %r, using generic; known: %s',
+            platform, ', '.join(sorted(drivers)))
+        return Driver()
+
+
+class Driver(object):
+    """Describes how to drive one platform's command line.
+
+    prompt matches any prompt of the platform, preceded by a line break,
+    and captures the part that identifies the device as 'host'.  Once a
+    prompt is seen, prompt_template, formatted with that part escaped,
+    becomes the exact prompt the session waits for.  enable_command and
+    disable_paging are sent after login unless None.  config_command
+    enters configuration mode and config_exit lists the commands that
+    commit and leave it.  running_config_command shows the configuration
+    in the indented form parse_config() reads.  pager_prompt matches the
+    pager's prompt, such as --More--, which is answered with pager_key
+    whenever paging stays on; pager_erase matches what the device sends
+    to erase the pager prompt afterwards.  Files are copied with
+    file_transfer, 'scp' or 'sftp', to file_system; load_command applies
+    such a file to the running configuration, from configuration mode if
+    load_in_config, and delete_command removes it.  confirm_prompt
+    matches the questions those commands ask, answered with Enter.
+    hostname_command matches commands that rename the device, after
+    which the prompt is learned again.
+    """
+
+    name = 'generic'
+    prompt = r'[\r\n](?P<host>\w[\w\-\:\.]+) ?(\(\w[\w\-\:\.]+\) ?)?[\>\$\#\%] ?$'
+    prompt_template = r'[\r\n]{0} ?(\(\w[\w\-\:\.]+\) ?)?[\>\$\#\%] ?$'
+    enable_command = None
+    disable_paging = None
+    error_patterns = (
+        r'% ?Invalid input',
+        r'% ?Incomplete command',
+        r'% ?Ambiguous command',
+        r'% ?Unknown command',
+        r'Command rejected',
+        )
+    config_command = None
+    config_exit = ()
+    running_config_command = None
+    pager_prompt = r' ?--More-- ?|---\(more(?: \d+%)?\)---'
+    pager_key = ' '
+    pager_erase = r'[\b]+ +[\b]+|\r +\r(?!\n)|\x1b\[K'
+    file_transfer = 'sftp'
+    file_system = ''
+    load_command = None
+    load_in_config = False
+    delete_command = None
+    confirm_prompt = r'\[[^\[\]\r\n]*\]\?? ?$'
+    hostname_command = r'^\s*hostname\s'
+
+
+
+class IOS(Driver):
+    name = 'ios'
+    prompt = r'[\r\n](?P<host>\w[\w\-\.]*) ?(\([\w\-\.\:\/]+\) ?)?[\>\#] ?$'
+    prompt_template = r'[\r\n]{0} ?(\([\w\-\.\:\/]+\) ?)?[\>\#] ?$'
+    enable_command = 'enable'
+    disable_paging = 'terminal length 0'
+    config_command = 'configure terminal'
+    config_exit = ('end',)
+    running_config_command = 'show running-config'
+    pager_prompt = r' ?--More-- ?'
+    file_transfer = 'scp'
+    file_system = 'flash:'
+    load_command = 'copy {0} running-config'
+    delete_command = 'delete /force {0}'
+
+
+class NXOS(IOS):
+    name = 'nxos'
+    enable_command = None
+    file_system = 'bootflash:'
+    delete_command = 'delete {0} no-prompt'
+    error_patterns = (
+        r'% ?Invalid (?:command|input|number|range|parameter)',
+        r'% ?Incomplete command',
+        r'% ?Ambiguous command',
+        r'Syntax error while parsing',
+        )
+
+
+class IOSXR(IOS):
+    name = 'iosxr'
+    prompt = r'[\r\n](?P<host>(?:RP/[\w/]+:)?\w[\w\-\.]*)(\([\w\-\.\:\/]+\))?# ?$'
+    prompt_template = r'[\r\n]{0}(\([\w\-\.\:\/]+\))?# ?$'
+    enable_command = None
+    error_patterns = IOS.error_patterns + (
+        r'% ?Failed to commit',
+        r'% ?This command is not authorized',
+        )
+    config_exit = ('commit', 'end')
+    file_system = 'disk0:'
+    load_command = 'load {0}'
+    load_in_config = True
+    delete_command = 'delete /noprompt {0}'
+
+
+class Junos(Driver):
+    name = 'junos'
+    prompt = r'[\r\n](?P<host>[\w\-\.]+@[\w\-\.]+)[\>\#\%] ?$'
+    prompt_template = r'[\r\n]{0}[\>\#\%] ?$'
+    disable_paging = 'set cli screen-length 0'
+    error_patterns = (
+        r'syntax error',
+        r'unknown command',
+        r'^\s*error:',
+        r'missing argument',
+        r'is ambiguous',
+        )
+    config_command = 'configure'
+    config_exit = ('commit and-quit',)
+    pager_prompt = r'---\(more(?: \d+%)?\)---'
+    file_system = '/var/tmp/'
+    load_command = 'load merge {0}'
+    load_in_config = True
+    delete_command = 'file delete {0}'
+    hostname_command = r'^\s*set system host-name\s'
+
+
+class EOS(IOS):
+    name = 'eos'
+    error_patterns = IOS.error_patterns + (
+        r'% ?Unrecognized command',
+        )
+    delete_command = 'delete {0}'
+
+
+class Linux(Driver):
+    name = 'linux'
+    prompt = r'[\r\n]\[?(?P<host>[\w\-\.]+@[\w\-\.]+)[^\r\n]*[\$\#] ?$'
+    prompt_template = r'[\r\n]\[?{0}[^\r\n]*[\$\#] ?$'
+    error_patterns = (
+        r'command not found',
+        r'No such file or directory',
+        r'Permission denied',
+        )
+    pager_prompt = None
+    file_system = '/tmp/'
+
+
+register_driver(Driver)
+register_driver(IOS, 'cisco', 'cisco_ios')
+register_driver(NXOS, 'cisco_nxos', 'nexus')
+register_driver(IOSXR, 'cisco_xr', 'xr')
+register_driver(Junos, 'juniper')
+register_driver(EOS, 'arista')
+register_driver(Linux)
+
+
+class BaseTerminal(object):
+    """Session state and prompt logic shared by Terminal and AsyncTerminal.
+
+    Holds the receive buffer, prompt patterns, banner mode and logging.
+    Nothing here performs network I/O, so the blocking and the asyncio
+    terminals match prompts and track banners with the same code.
     """
 
+    login_prompt = r'[Uu]sername|[Ll]ogin|[Nn]ame'
+    password_prompt = r'[Pp]assword'
+    auth_fail = r'Authentication failed'
+    enable_prompt = r'^\w[\w\(\)]+ ?[\>\$\#] ?$|[Pp]assword:? ?$'
+
     def __init__(self, host, port=None, protocol=None, **kwargs):
-        global debug_level
         self.debug = kwargs.get('debug', 0)
-        debug_level = self.debug
-        debug_display_info(debug=self.debug)
+        if self.debug:
+            enable_debug(self.debug)
         self.kwargs = kwargs
-        self.platform = kwargs.get('platform', 'cisco')
+        self.driver = get_driver(kwargs.get('platform', 'cisco'))
+        self.platform = self.driver.name
         try:
             self.username = kwargs['username']
             self.password = kwargs['password']
         except KeyError as exception:
             print('Missing required argument: {0}'.format(exception), file=sys.stderr)
         self.host = host
-        self.protocol, self.port = determine_protocol(host, protocol, port)
+        self.protocol, self.port = protocol, port
         self._set_defaults()
-        self.connect()
 
-    def __iter__(self):
-        """Not really sure this class needs to be iterable.
-        It was a good coding excercise, might have added some complexity 
-        to the update buffer method in the fine-tuning delays 
-        and trying to detect when no more buffer will be sent.
-        """
-        return self
+    @property
+    def data_buffer(self):
+        """All output received and not yet consumed, as one string."""
+        return self.buffer.text()
 
-    def __next__(self):
-        # python3 method calls python2 method.
-        # I did it this way because python2 method is 'public'
-        return self.next()
+    @property
+    def exceptions(self):
+        """Exception types a session may raise; see pyvty.exceptions."""
+        return _exceptions()
+
+    @data_buffer.setter
+    def data_buffer(self, text):
+        self.buffer = ReceiveBuffer(text)
 
     def _set_defaults(self):
-        debug_display_info(debug=self.debug)
         self.terminal = None
+        self.selector = None
         self.data_buffer = u''
+        self.matched_length = 0
+        self.lookbehind = 1024
         self.last_regex_match = u''
         self.banner = False
         self.prompt_matched = False
-        self.timeout = 20
-        self.prompt = r'[\r\n](\w[\w\-\:\.]+ ?(\(\w[\w\-\:\.]+\) ?)?[\>\$\#\%] ?)$'
-        self.logfile = self.kwargs.get('logfile', None)
+        self.timeout = self.kwargs.get('timeout', 20)
+        self.deadline = self.kwargs.get('deadline')
+        self.cancel = self.kwargs.get('cancel')
+        self.strict = self.kwargs.get('strict', False)
+        self.prompt = self.driver.prompt
+        self.hostname = None
+        self.tracer = self.kwargs.get('trace') or None
+        if self.tracer is True:
+            self.tracer = Tracer()
+        self.metrics = self.kwargs.get('metrics', True) or None
+        if self.metrics is True:
+            self.metrics = Metrics()
+        self.logfile = None
+        self.transcript = None
+        self.secrets = set([getattr(self, 'password', None)])
+        if self.kwargs.get('logfile'):
+            self.set_logging(self.kwargs['logfile'], 'a')
+        self.encoding = self.kwargs.get('encoding', 'utf-8')
+        self.errors = self.kwargs.get('errors', 'replace')
+        self.decoder = codecs.getincrementaldecoder(self.encoding)(self.errors)
         self.last_regex_match = u''
-        self.disable_paging = u'terminal length 0'
+        self.disable_paging = self.driver.disable_paging
+        self.pager = None
+        if self.kwargs.get('pager', True) and self.driver.pager_prompt:
+            self.pager = compile_regex(r'(?:{0})\Z'.format(self.driver.pager_prompt))
+            self.pager_erase = compile_regex(self.driver.pager_erase)
+        self.pager_key = self.driver.pager_key
+        self.erase_pending = None
+        self.pages = 0
+        self.exec_mode = self.kwargs.get('exec_mode', False)
+        self.error_patterns = list(self.driver.error_patterns)
         self.send_delay = 0.1
         self.read_delay = 0.002
         self.read_retries = 50
-        self.exceptions = (
-            socket.timeout,
-            socket.error,
-            paramiko.BadHostKeyException,
-            paramiko.AuthenticationException,
-            paramiko.SSHException,
-            UserWarning,
-            )
-
-    def connect(self, **kwargs):
-        # check kwargs - is this called by user or class ??
-        # self.terminal should be assigned to False in __init__
-        debug_display_info(debug=self.debug)
-        hostdict = {
-            'port':self.port, 
-            'username':self.username, 
-            'password':self.password,
-            }
-        if self.terminal:
-            return False
-        if self.protocol is None:
-            raise socket.error('Cannot connect to host via ssh or telnet.')
-        if self.protocol == 'ssh':
-            self.terminal = SSH(self.host, **hostdict)
-        elif self.protocol == 'telnet':
-            self.terminal = Telnet(self.host, **hostdict)
-            self.login(self.username, self.password)
-        if self.platform == 'cisco':
-            self.enable_privilege()
-            self.send(self.disable_paging)
-        return True
+        self.adaptive = self.kwargs.get('adaptive', True)
+        self.timing = self.kwargs.get('timing') or TimingProfile()
+        if isinstance(self.timing, dict):
+            self.timing = TimingProfile(**self.timing)
+        self._tune()
+
+    def _search(self, regex, start):
+        """Returns the first regex match that starts past matched_length.
+
+        Only output from position start onwards is searched.  Text kept in
+        data_buffer from the previous match is context for the next search,
+        so it must not satisfy that search, not even by running on into new
+        output, as a prompt ending in ' ?' would into an indented echo.
+        Returns (offset, match) with match positions relative to offset.
+        """
+        offset, text = self.buffer.tail(start)
+        regex_match = regex.search(text, start - offset)
+        while regex_match and offset + regex_match.start() < self.matched_length:
+            regex_match = regex.search(text, regex_match.start() + 1)
+        return offset, regex_match
 
-    def close(self):
-        if self.terminal:
-            self.terminal._close()
-            self.terminal = None
+    def _take_regex_match(self, regex, start=0):
+        """Consumes output up to the first match of a compiled regex.
 
-    def login(self, 
-            username, 
-            password, 
-            enable_command="enable", 
-            enable_password=None,
-            ):
-        """Login to terminal session and elevate privilege level.
-        
-        Requires username, password.
+        Returns the text before the match, or None if there is no match yet.
+        The matched text stays in data_buffer as context for the next search.
         """
-        debug_display_info(debug=self.debug)
-        debug_display_info(debug=self.debug, message=self.data_buffer)
-        login_prompt = r'[Uu]sername|[Ll]ogin|[Nn]ame'
-        password_prompt = r'[Pp]assword'
-        auth_fail = r'Authentication failed'
-
-        self.read_until_regex(r'|'.join((self.prompt, login_prompt)))
-        debug_message = 'LAST MATCH = {0}'.format(self.last_regex_match)
-        debug_display_info(debug=self.debug, message=debug_message)
-        if re.search(self.prompt, self.last_regex_match):
-            debug_message = 'LEAVING LOGIN -- ALREADY LOGGED IN!'
-            debug_display_info(debug=self.debug, message=debug_message)
-            return True
-        self.write(username)
-        self.read_until_regex(password_prompt)
-        debug_message = 'LAST MATCH = {0}'.format(self.last_regex_match)
-        debug_display_info(debug=self.debug, message=debug_message)
-        self.write(password)
-        self.read_until_regex(r'|'.join((self.prompt, login_prompt, auth_fail)))
-        if re.search(r'|'.join((login_prompt, auth_fail)), self.last_regex_match):
-            raise UserWarning('Authentication Failed')
+        offset, regex_match = self._search(regex, start)
+        if not regex_match:
+            return None
+        self.prompt_matched = True
+        self.last_regex_match = regex_match.group()
+        output = self.buffer.split(offset + regex_match.start())
+        self.matched_length = len(self.last_regex_match)
+        return output
 
-    def next(self):
-        """Returns one line at a time when object is called as an interable.
+    def _take_match(self, match, start=0):
+        """Consumes output up to the first occurence of a plain string.
 
-        Method returns the available output up until first newline encountered.
-        If no newline exists, all remaining output is returned.
+        Returns the text before the match, or None if there is no match yet.
         """
-        debug_display_info(debug=self.debug)
-        time.sleep(self.read_delay)
-        if not '\n' in self.data_buffer:
-            self.update_buffer()
-        if not self.data_buffer:
-            raise StopIteration
-        try:
-            output, self.data_buffer = self.data_buffer.split('\n', 1)
-        except ValueError:
-            output, self.data_buffer = self.data_buffer, u''
+        start = max(start, self.matched_length - len(match) + 1, 0)
+        offset, text = self.buffer.tail(start)
+        position = text.find(match, start - offset)
+        if position < 0:
+            return None
+        output = self.buffer.split(offset + position)
+        self.matched_length = len(match)
         return output
 
-    def enable_privilege(self, command="enable", password=None):
-        """Elevate privilege level from read-only to read-write
-        
-        Also called 'enable mode'.
-        By default, uses the same password that was used at login.
-        Specify password='some_other_password' to override.
-        Sends the command 'enable' by default.
-        Use privilege_command='enable'
+    def _next_scan(self, match=None):
+        """Returns where the next search of data_buffer should start.
+
+        Searches for a plain string resume just far enough back to catch a
+        match split across reads; regex searches keep lookbehind characters.
+        """
+        if match is None:
+            return max(0, len(self.buffer) - self.lookbehind)
+        return max(0, len(self.buffer) - len(match) + 1)
+
+    def _span(self, name, detail=None):
+        """Returns a context manager timing name into the tracer and metrics.
+
+        Returns a no-op when there is neither.
+        """
+        if self.tracer is None and self.metrics is None:
+            return null_span
+        return Span(self.tracer, name, detail, self.metrics)
+
+    def _count(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.add(name, value)
+
+    def _connecting(self):
+        """Counts a connect, and a reconnect if the session was opened before."""
+        if self.metrics is not None:
+            if self.metrics.counters.get('connects'):
+                self.metrics.add('reconnects')
+            self.metrics.add('connects')
+
+    def _append(self, received_data):
+        """Decodes and logs received output and appends it to data_buffer.
+
+        Bytes are decoded incrementally, so a character split across two
+        reads is decoded once both halves arrive.  In bytes mode the output
+        is appended undecoded.
+        """
+        if self.decoder is None:
+            if self.transcript:
+                self.transcript.write(
+                    received_data.decode(self.encoding, 'replace'), '<')
+        else:
+            received_data = self.decoder.decode(received_data)
+            if self.transcript:
+                self.transcript.write(received_data, '<')
+            if self.erase_pending is not None:
+                received_data = self._strip_erase(received_data)
+        self.buffer.append(received_data)
+        self.timing.received(len(received_data))
+        self._tune()
+
+    def _page(self):
+        """Answers a pager prompt left at the end of data_buffer.
+
+        The pager prompt is cut from data_buffer, and _strip_erase then
+        removes the erase sequence that follows the key, so the output
+        reads as if paging were off.  Returns the key to send, or None
+        when the output does not end in a pager prompt.
+        """
+        start = max(0, len(self.buffer) - 64)
+        offset, text = self.buffer.tail(start)
+        match = self.pager.search(text, start - offset)
+        if match is None:
+            return None
+        self.buffer.truncate(offset + match.start())
+        self.erase_pending = u''
+        self.pages += 1
+        self._count('pages')
+        log.debug('answering pager prompt %r', match.group())
+        return self.pager_key.encode(self.encoding)
+
+    def _strip_erase(self, text):
+        """Removes the pager's erase sequence from the start of new output.
+
+        A sequence split across reads is held back until it is complete.
+        """
+        text = self.erase_pending + text
+        erase = self.pager_erase.match(text)
+        if erase and erase.end() < len(text):
+            self.erase_pending = None
+            return text[erase.end():]
+        if len(text) < 64 and not text.strip(u'\b \r\x1b[K'):
+            self.erase_pending = text
+            return u''
+        # Not an erase sequence: this device sends none.
+        self.erase_pending = None
+        return text
+
+    def _tune(self):
+        """Applies the learned timing to send_delay and read_delay."""
+        if self.adaptive and self.timing.learned:
+            self.send_delay = self.timing.send_delay
+            self.read_delay = self.timing.idle_timeout / self.read_retries
+
+    def _log_input(self, text):
+        """Adds text sent to the device to the transcript, hiding passwords."""
+        if self.transcript:
+            if text in self.secrets:
+                text = u'********'
+            self.transcript.write(text, '>')
+
+    def _native(self, text):
+        """Encodes a str pattern to bytes while the terminal is in bytes mode."""
+        if self.decoder is None and not isinstance(text, bytes):
+            return text.encode(self.encoding)
+        return text
+
+    @contextlib.contextmanager
+    def _bytes_mode(self):
+        """Collects received output as undecoded bytes inside the block.
+
+        Output already decoded is re-encoded into the bytes buffer, along
+        with any partial character the decoder is holding.  On exit the
+        leftover bytes are decoded back into data_buffer.
+        """
+        text = self.buffer.text()
+        pending = self.decoder.getstate()[0]
+        self.decoder.reset()
+        decoder, self.decoder = self.decoder, None
+        self.matched_length = len(text[:self.matched_length].encode(self.encoding))
+        self.buffer = ReceiveBuffer(text.encode(self.encoding) + pending)
+        try:
+            yield
+        finally:
+            self.decoder = decoder
+            raw = self.buffer.text()
+            self.matched_length = len(
+                raw[:self.matched_length].decode(self.encoding, self.errors))
+            self.buffer = ReceiveBuffer(self.decoder.decode(raw))
+            if isinstance(self.last_regex_match, bytes):
+                self.last_regex_match = self.last_regex_match.decode(
+                    self.encoding, self.errors)
+
+    def _timed_out(self, timeout):
+        """Records a failed match and returns all buffered output."""
+        # Should I overwrite self.last_regex_match?
+        self.prompt_matched = False
+        log.debug('Timed out after %s seconds.', timeout)
+        output = self.buffer.text()
+        self.buffer.clear()
+        self.matched_length = 0
+        return output
+
+    def _wait_failed(self, timeout):
+        """Ends a wait whose match never came.
+
+        Returns the buffered output, or with strict raises it inside
+        ConnectionLost if the session closed, else PromptTimeout.
+        """
+        output = self._timed_out(timeout)
+        if self.terminal is None or self.terminal._at_eof():
+            self._count('connections_lost')
+        else:
+            self._count('idle_timeouts')
+        if not self.strict:
+            return output
+        if self.terminal is None or self.terminal._at_eof():
+            raise ConnectionLost('{0} closed the session.'.format(self.host), output)
+        raise PromptTimeout('No match after {0} seconds without output.'
+            .format(timeout), output, 'idle')
+
+    def _check_limits(self):
+        """Raises PromptTimeout if cancelled or past the deadline."""
+        if self.cancel is not None and self.cancel.cancelled:
+            reason, message, counter = 'cancelled', 'Cancelled.', 'cancellations'
+        elif self.deadline is not None and time.time() >= self.deadline:
+            reason, message, counter = 'deadline', 'Deadline passed.', 'deadlines'
+        else:
+            return
+        log.debug('%s: %s', self.host, message)
+        self._count(counter)
+        raise PromptTimeout(message, self._timed_out(None), reason)
+
+    def _wait_slice(self, end_time):
+        """Returns how long the next wait may block before end_time.
+
+        Waits stop short at the deadline and wake every poll_interval to
+        look at the cancel token.
+        """
+        now = time.time()
+        wait = end_time - now
+        if self.deadline is not None:
+            wait = min(wait, self.deadline - now)
+        if self.cancel is not None:
+            wait = min(wait, self.cancel.poll_interval)
+        return max(wait, 0)
+
+    @contextlib.contextmanager
+    def limits(self, deadline=None, cancel=None):
+        """Applies a deadline and/or cancel token to the waits in a with block.
+
+        deadline is a time.time() value; the earlier of it and the
+        session's own deadline applies.  The session's previous limits
+        return when the block ends.
+        """
+        saved = self.deadline, self.cancel
+        if deadline is not None and (self.deadline is None or deadline < self.deadline):
+            self.deadline = deadline
+        if cancel is not None:
+            self.cancel = cancel
+        try:
+            yield
+        finally:
+            self.deadline, self.cancel = saved
+
+    def _banner_start(self, command, timeout):
+        """Enters banner mode if command starts a multi-line banner.
+
+        Returns the timeout to use while waiting for the command's prompt.
+        """
+        if command.lstrip().startswith('banner'):
+            if len(command.lstrip().split()) > 2:
+                self.banner = command.lstrip().split()[2][0]
+            else:
+                self.banner = command.lstrip().split()[-1][0]
+            log.debug('banner delimeter = %s', self.banner)
+            if len(command.lstrip().split()) > 3:
+                if self.banner == command.lstrip().split()[-1][-1]:
+                    self.banner = False
+                    log.debug('banner delimeter found in banner statement.')
+        if self.banner:
+            timeout = 0.2
+            log.debug('banner timeout set to %s seconds.', timeout)
+        return timeout
+
+    def _banner_finish(self, command):
+        """Leaves banner mode once the prompt or the delimiter comes back."""
+        if self.banner:
+            if self.prompt_matched or command.lstrip().startswith(self.banner):
+                self.banner = False
+                log.debug('banner mode off -- matched prompt or delimeter.')
+
+    def learn_prompt(self, text=None):
+        """Narrows self.prompt to this device's own prompt.
+
+        text, by default the last prompt matched, is parsed with the
+        driver's prompt grammar; the device part of it, such as the
+        hostname, is then matched literally, so '#' or '>' inside command
+        output can no longer end a read early.  Call again after changing
+        the hostname; send() and send_batch() do so themselves when they
+        send the driver's hostname_command.  Returns the learned part, or
+        None if text is not a prompt.
+        """
+        if text is None:
+            text = self.last_regex_match
+        match = compile_regex(self.driver.prompt).search(text)
+        if not match:
+            return None
+        self.hostname = match.group('host')
+        self.prompt = self.driver.prompt_template.format(re.escape(self.hostname))
+        self.enable_prompt = r'|'.join((self.prompt, r'[Pp]assword:? ?$'))
+        log.debug('learned prompt %r', self.prompt)
+        return self.hostname
+
+    def _hostname_change(self, command):
+        """Goes back to the driver's prompt if command renames the device.
+
+        The learned prompt would no longer match once the new name shows.
+        Returns True if so; call learn_prompt() after the prompt matches.
+        """
+        if self.hostname is None or not self.driver.hostname_command:
+            return False
+        if not compile_regex(self.driver.hostname_command).search(command):
+            return False
+        log.debug('%r renames %s: prompt unlearned', command, self.hostname)
+        self.prompt = self.driver.prompt
+        return True
+
+    def set_logging(self, filename, mode=None, **kwargs):
+        """Set logfile to capture terminal input and output
+
+        Specify a filename to start logging.
+        Specify None to stop logging.
+        mode can be set to 'a' to append to an existing file.
+        Default mode is 'w', which will overwrite any existing file.
+        Other keyword arguments (format, max_bytes, interval, compress,
+        queue_size, policy) are passed to TranscriptWriter.
+        A TranscriptWriter may be given in place of a filename.
         """
-        debug_display_info(debug=self.debug)
-        if password is None:
-            password = self.password
-        prompt = r'^\w[\w\(\)]+ ?[\>\$\#] ?$|[Pp]assword:? ?$'
-        #self.write('')
-        #self.read_until_regex(prompt)
-        self.write(command)
-        self.read_until_regex(prompt)
-        current_match = self.last_regex_match
-        while re.search(r'[Pp]assword:? ?$', current_match):
+        if not mode == 'a':
+            mode = 'w'
+        self._close_transcript()
+        if filename is None:
+            self.logfile = False
+        elif isinstance(filename, TranscriptWriter):
+            self.transcript = filename
+            self.logfile = filename.filename
+        else:
+            self.transcript = TranscriptWriter(filename, mode, **kwargs)
+            self.logfile = filename
+
+    def _close_transcript(self):
+        if self.transcript:
+            self.transcript.close()
+            self.transcript = None
+
+    def write_to_log(self, output, prefix=None):
+        """Writes string to the current logging file if logging is enabled
+        
+        Accepts a string.
+        Used internally, but useful for inserting debug comments.
+        """
+        if prefix is None:
+            prefix = str(datetime.datetime.fromtimestamp(time.time()))
+        if self.transcript:
+            return self.transcript.write(prefix + output, '#')
+        return False
+
+
+class Terminal(BaseTerminal):
+    """Provides common methods to access a terminal using multiple protocols.
+
+    Provides common methods to child classes.
+    Child classes will provide primitive methods for connection setup,
+    send, read, and connection close, which are unique to each implementation.
+    The methods provided here leverage primitive methods to provide
+    compex, common methods.  The child classes will inherit this logic.
+    """
+
+    def __init__(self, host, port=None, protocol=None, **kwargs):
+        BaseTerminal.__init__(self, host, port, protocol, **kwargs)
+        self.reachability = self.kwargs.get('reachability')
+        if self.kwargs.get('replay'):
+            info = Replay.session_info(self.kwargs['replay'])
+            self.protocol, self.port = info.get('protocol'), info.get('port')
+        else:
+            self.protocol, self.port = determine_protocol(
+                host, protocol, port, self.reachability)
+        try:
+            self.connect()
+        except socket.error:
+            if self.reachability is not None:
+                self.reachability.discard(host)
+            raise
+
+    def __iter__(self):
+        """Not really sure this class needs to be iterable.
+        It was a good coding excercise, might have added some complexity 
+        to the update buffer method in the fine-tuning delays 
+        and trying to detect when no more buffer will be sent.
+        """
+        return self
+
+    def __next__(self):
+        # python3 method calls python2 method.
+        # I did it this way because python2 method is 'public'
+        return self.next()
+
+    def connect(self, **kwargs):
+        # check kwargs - is this called by user or class ??
+        # self.terminal should be assigned to False in __init__
+        hostdict = {
+            'port':self.port, 
+            'username':self.username, 
+            'password':self.password,
+            }
+        if self.terminal:
+            return False
+        if self.protocol is None:
+            raise socket.error('Cannot connect to host via ssh or telnet.')
+        if self.exec_mode and (self.protocol != 'ssh' or self.kwargs.get('replay')):
+            raise UserWarning('exec_mode requires a live ssh session.')
+        self._connecting()
+        with self._span('connect', self.host):
+            if self.kwargs.get('replay'):
+                self.terminal = Replay(self.kwargs['replay'],
+                    self.kwargs.get('replay_speed', 1.0))
+            elif self.protocol == 'ssh':
+                self.terminal = SSH(self.host, shell=not self.exec_mode, **hostdict)
+            elif self.protocol == 'telnet':
+                self.terminal = Telnet(self.host, **hostdict)
+        if self.kwargs.get('record') and not self.exec_mode:
+            self.terminal = Recorder(self.terminal, self.kwargs['record'],
+                {'host': self.host, 'port': self.port, 'protocol': self.protocol},
+                self.secrets)
+        if self.exec_mode:
+            return True
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.terminal, selectors.EVENT_READ)
+        if self.protocol == 'telnet':
+            self.login(self.username, self.password)
+        else:
+            # Take the first prompt, so later reads cannot match it.
+            self.read_until_regex(self.prompt)
+        self.learn_prompt()
+        if self.driver.enable_command:
+            self.enable_privilege(self.driver.enable_command)
+        if self.disable_paging:
+            self.send(self.disable_paging)
+        return True
+
+    def close(self):
+        if self.selector:
+            self.selector.close()
+            self.selector = None
+        if self.terminal:
+            self.terminal._close()
+            self.terminal = None
+        self._close_transcript()
+
+    def login(self, 
+            username, 
+            password, 
+            enable_command="enable", 
+            enable_password=None,
+            ):
+        """Login to terminal session and elevate privilege level.
+        
+        Requires username, password.
+        """
+        with self._span('login', self.host):
+            log.debug('login to %s', self.host)
+            login_prompt = self.login_prompt
+            auth_fail = self.auth_fail
+
+            self.read_until_regex(r'|'.join((self.prompt, login_prompt)))
+            log.debug('LAST MATCH = %r', self.last_regex_match)
+            if compile_regex(self.prompt).search(self.last_regex_match):
+                log.debug('LEAVING LOGIN -- ALREADY LOGGED IN!')
+                return True
+            self.write(username)
+            self.read_until_regex(self.password_prompt)
+            log.debug('LAST MATCH = %r', self.last_regex_match)
             self.write(password)
+            self.read_until_regex(r'|'.join((self.prompt, login_prompt, auth_fail)))
+            if compile_regex(r'|'.join((login_prompt, auth_fail))).search(
+                    self.last_regex_match):
+                raise UserWarning('Authentication Failed')
+
+    def next(self):
+        """Returns one line at a time when object is called as an interable.
+
+        Method returns the available output up until first newline encountered.
+        If no newline exists, all remaining output is returned.
+        """
+        if not '\n' in self.data_buffer:
+            self.update_buffer()
+        if not self.data_buffer:
+            raise StopIteration
+        try:
+            output, self.data_buffer = self.data_buffer.split('\n', 1)
+        except ValueError:
+            output, self.data_buffer = self.data_buffer, u''
+        self.matched_length = max(0, self.matched_length - len(output) - 1)
+        return output
+
+    def enable_privilege(self, command="enable", password=None):
+        """Elevate privilege level from read-only to read-write
+        
+        Also called 'enable mode'.
+        By default, uses the same password that was used at login.
+        Specify password='some_other_password' to override.
+        Sends the command 'enable' by default.
+        Use privilege_command='enable'
+        """
+        with self._span('enable', self.host):
+            if password is None:
+                password = self.password
+            self.secrets.add(password)
+            prompt = self.enable_prompt
+            #self.write('')
+            #self.read_until_regex(prompt)
+            self.write(command)
             self.read_until_regex(prompt)
             current_match = self.last_regex_match
-        if re.search(r'# ?$', current_match):
-            return True
-        return False
+            while re.search(r'[Pp]assword:? ?$', current_match):
+                self.write(password)
+                self.read_until_regex(prompt)
+                current_match = self.last_regex_match
+            if re.search(r'# ?$', current_match):
+                return True
+            return False
 
     def flush_buffer(self):
         """Discards all available terminal output."""
-        debug_display_info(debug=self.debug)
         self.terminal._read()
-        self.data_buffer = u''
+        self.buffer.clear()
+        self.matched_length = 0
+        return True
+
+    def wait_readable(self, timeout):
+        """Blocks until terminal output is available or timeout expires.
+
+        Returns True if the transport has output waiting to be read.
+        """
+        if timeout < 0:
+            timeout = 0
+        if self.metrics is None:
+            return bool(self.selector.select(timeout))
+        start_time = time.time()
+        ready = bool(self.selector.select(timeout))
+        self.metrics.add('wait_seconds', time.time() - start_time)
+        return ready
+
+    def _read_raw(self, timeout):
+        """Waits up to timeout seconds for output and returns it undecoded.
+
+        Returns as soon as any output arrives.  Returns b'' if the timeout
+        expires, or the remote end closes the session, before output arrives.
+        Raises PromptTimeout once cancelled or past the deadline.
+        """
+        if self.exec_mode:
+            raise UserWarning('read requires an interactive session; use exec_commands.')
+        end_time = time.time() + timeout
+        limited = self.deadline is not None or self.cancel is not None
+        while True:
+            if limited:
+                self._check_limits()
+            if self.tracer is None:
+                received_data = self.terminal._read()
+            else:
+                with self.tracer.span('read'):
+                    received_data = self.terminal._read()
+            if received_data:
+                self._count('bytes_in', len(received_data))
+                return received_data
+            if end_time <= time.time() or self.terminal._at_eof():
+                return b''
+            if limited:
+                self.wait_readable(self._wait_slice(end_time))
+            else:
+                self.wait_readable(end_time - time.time())
+
+    def _receive(self, timeout):
+        """Waits up to timeout seconds for output and appends it to data_buffer.
+
+        Returns False if no output arrived; see _read_raw.  A pager prompt
+        is answered at once.
+        """
+        received_data = self._read_raw(timeout)
+        if not received_data:
+            return False
+        start_time = time.time()
+        self._append(received_data)
+        if self.pager is not None and self.decoder is not None:
+            key = self._page()
+            if key:
+                self.terminal._write(key)
+                self._count('bytes_out', len(key))
+        self._count('receive_seconds', time.time() - start_time)
         return True
 
     def update_buffer(self, retries=None):
-        """Reads all avalable terminal output and appends to data_buffer."""
-        debug_display_info(debug=self.debug)
+        """Reads all avalable terminal output and appends to data_buffer.
+
+        Returns once no output has arrived for read_delay * retries seconds,
+        or as soon as the output ends with what looks like a shell prompt.
+        """
         if retries is None:
             retries = self.read_retries
         result = False
-        early_exit = re.compile(r'(?<![\>\$\#\%])([\>\$\#\%] ?$)')
-        this_delay = self.read_delay
-        max_delay = self.read_delay * retries
-        while this_delay <= max_delay:
-            received_data = self.terminal._read()
-            if received_data:
-                self.write_to_log(received_data, prefix='')
-                result = True
-                self.data_buffer += received_data
-                this_delay = self.read_delay
-                if early_exit.search(self.data_buffer):
-                    # We may have found shell prompt: minimize max_delay.
-                    max_delay = this_delay
-                else:
-                    # Ensure max delay is reset to original value.
-                    max_delay = self.read_delay * retries
-            else:
-                # No data received: increment this_delay
-                this_delay += self.read_delay
-            time.sleep(self.read_delay)
-        debug_display_info(debug=self.debug, message=self.data_buffer)
+        early_exit = compile_regex(self._native(r'(?<![\>\$\#\%])([\>\$\#\%] ?$)'))
+        idle_timeout = self.read_delay * retries
+        while self._receive(idle_timeout):
+            result = True
+            offset, tail = self.buffer.tail(max(0, len(self.buffer) - 3))
+            if early_exit.search(tail, max(0, len(tail) - 3)):
+                # We may have found shell prompt: stop waiting for more.
+                break
         return result
 
     def read(self):
         """Returns all available terminal output  as a string"""
-        debug_display_info(debug=self.debug)
         self.update_buffer()
-        output, self.data_buffer = self.data_buffer, u''
+        output = self.buffer.split(len(self.buffer))
+        self.matched_length = 0
         return output
 
+    def read_bytes(self):
+        """Returns all available terminal output as undecoded bytes."""
+        with self._bytes_mode():
+            return self.read()
+
     def read_until(self, match, timeout=None):
         """This will match a pattern, return text before the first match."""
         if timeout is None:
             timeout = self.timeout
-        debug_display_info(debug=self.debug)
-        debug_display_info(debug=self.debug, message='match = {0}'.format(match))
-        time.sleep(self.read_delay)
+        log.debug('match = %r', match)
+        match = self._native(match)
         end_time = time.time() + timeout
-        while end_time > time.time():
-            while self.update_buffer():
-                end_time = time.time() + timeout
-            if match in self.data_buffer:
-                (output, post_match) = self.data_buffer.split(match, 1)
-                self.data_buffer = match + post_match
+        start = 0
+        while True:
+            output = self._take_match(match, start)
+            if output is not None:
                 return output
-            else:
-                time.sleep(0.1)
-        # Reached timeout at this point: should I raise an exception?
-        output = self.data_buffer
+            start = self._next_scan(match)
+            if not self._receive(end_time - time.time()):
+                break
+            end_time = time.time() + timeout
+        output = self._wait_failed(timeout)
         self.flush_buffer()
         return output
 
-    def read_until_regex(self, match, timeout=None):
+    def read_until_regex(self, match, timeout=None, deadline=None):
         """This will match a regular expression.
         
         Return everything before the first regex match.
         self.last_regex_match is assigned the string matching the regex.
         Timeout counter is reset whenever new data appears on terminal.
-        If timeout occurs, self.last_regex_match will keep previous value.
+        If timeout occurs, self.last_regex_match will keep previous value,
+        and the output is returned, or raised in PromptTimeout if strict.
+        deadline, a time.time() value, bounds the whole wait however much
+        output keeps arriving.
         """
-        ###  Should check if terminal closed, and then return the buffer.
-        debug_display_info(debug=self.debug)
-        debug_display_info(debug=self.debug, message='match = {0}'.format(match))
-        if timeout is None:
-            timeout = self.timeout
-        time.sleep(self.read_delay)
-        end_time = time.time() + timeout
-        regex = re.compile(match, re.MULTILINE)
-        while end_time > time.time():
-            while self.update_buffer():
+        with self._span('prompt_wait', match), self.limits(deadline):
+            ###  Should check if terminal closed, and then return the buffer.
+            log.debug('match = %r', match)
+            if timeout is None:
+                timeout = self.timeout
+            end_time = time.time() + timeout
+            regex = compile_regex(self._native(match))
+            start = 0
+            while True:
+                output = self._take_regex_match(regex, start)
+                if output is not None:
+                    return output
+                start = self._next_scan()
+                if not self._receive(end_time - time.time()):
+                    break
                 end_time = time.time() + timeout
-            regex_match = regex.search(self.data_buffer)
-            if regex_match:
-                self.prompt_matched = True
-                self.last_regex_match = regex_match.group()
-                split_up = regex.split(self.data_buffer, 1)
-                (output, post_match) = split_up[0], split_up[-1]
-                self.data_buffer = self.last_regex_match + post_match
-                return output
-            else:
-                time.sleep(0.1)
-        # Reached timeout at this point: should I raise an exception?
-        # Should I overwrite self.last_regex_match? 
-        self.prompt_matched = False
-        debug_message = '%%% Timed out after {0} seconds.'.format(timeout)
-        debug_display_info(debug=self.debug, message=debug_message)
-        output = self.data_buffer
-        self.flush_buffer()
-        return output
+            output = self._wait_failed(timeout)
+            self.flush_buffer()
+            return output
 
     def write(self, text, end='\n', send=True):
         """Sends string to terminal with trailing newline.
@@ -464,10 +2243,21 @@ class Terminal(object):
         """
         if not send:
             return '[SEND=FALSE] {0}'.format(command)
-        debug_display_info(debug=self.debug)
-        debug_display_info(debug=self.debug, message='WRITE: {0}'.format(text))
-        result = self.terminal._write(text + end)
-        time.sleep(self.send_delay)
+        if self.exec_mode:
+            raise UserWarning('send requires an interactive session; use exec_commands.')
+        log.debug('WRITE: %r', text)
+        self._log_input(text)
+        data = (text + end).encode(self.encoding)
+        result = self.terminal._write(data)
+        self._count('bytes_out', len(data))
+        self.timing.sent()
+        if self.send_delay > 0:
+            # Note when the reply starts while settling, to time the round trip.
+            end_time = time.time() + self.send_delay
+            if self.wait_readable(self.send_delay):
+                self.timing.replied()
+                self._tune()
+            time.sleep(max(0, end_time - time.time()))
         return result
 
     def _send_main(self, command, prompt, timeout, end):
@@ -478,44 +2268,33 @@ class Terminal(object):
         #       rather then return an error meesage
         #       leaving the script to handle the exception
         #    I don't think I can make it 'wrappable' via 'with' context manager
-        debug_display_info(debug=self.debug)
-        
-        # Banner Checking
-        if command.lstrip().startswith('banner'):
-            if len(command.lstrip().split()) > 2:
-                self.banner = command.lstrip().split()[2][0]
-            else:
-                self.banner = command.lstrip().split()[-1][0]
-            debug_message = 'banner delimeter = {0}'.format(self.banner)
-            debug_display_info(debug=self.debug, message=debug_message)
-            if len(command.lstrip().split()) > 3:
-                if self.banner == command.lstrip().split()[-1][-1]:
-                    self.banner = False
-                    debug_message = 'banner delimeter found in banner statement.'
-                    debug_display_info(debug=self.debug, message=debug_message)
-        # Banner Checking
-        if self.banner:        
-            timeout = 0.2
-            debug_message = 'banner timeout set to {0} seconds.'.format(timeout)
-            debug_display_info(debug=self.debug, message=debug_message)
-        
+        timeout = self._banner_start(command, timeout)
+
         # Write to the terminal
         self.write(command, end='\n')
         # Read back from the terminal
-        result = u''
+        result = self._native(u'')
         if command != '':
-            result = self.read_until(command.splitlines()[0][0:20], timeout=3)
-        result += self.read_until_regex(prompt, timeout)
-        
-        # Disable banner mode
-        if self.banner:
-            if self.prompt_matched or command.lstrip().startswith(self.banner):
-                self.banner = False
-                debug_message = 'banner mode off -- matched prompt or delimeter.'
-                debug_display_info(debug=self.debug, message=debug_message)
+            retained = self.matched_length
+            try:
+                result = self.read_until(command.splitlines()[0][0:20], timeout=3)
+            except PromptTimeout as error:
+                # No echo is not fatal: look for the prompt in what came,
+                # but not in the previous prompt still at its start.
+                if error.reason != 'idle':
+                    raise
+                self.data_buffer = error.output
+                self.matched_length = retained
+        try:
+            result += self.read_until_regex(prompt, timeout)
+        except (PromptTimeout, ConnectionLost) as error:
+            error.output = result + error.output
+            raise
+        self._banner_finish(command)
         return result
 
-    def send(self, command, prompt=None, timeout=None, send=True, end='\n'):
+    def send(self, command, prompt=None, timeout=None, send=True, end='\n',
+            deadline=None):
         """Sends a command to the terminal and waits for the prompt to return.
         
         Returns a string of output from the terminal.
@@ -523,50 +2302,474 @@ class Terminal(object):
         Optional prompt specifies the an expected prompt in regex format.
         Object.last_regex_match is assigned the string matching the prompt.
         Optional timeout specifies time in seconds to wait for the prompt.
+        Optional deadline, a time.time() value, is when to give up even
+        if output is still arriving; PromptTimeout is raised then.
         Optional send=False prevents the string from being sent.  This is
         useful when you want to verify what will be sent before sending.
         """
-        debug_display_info(debug=self.debug)
         if not send:
             result = '[SEND=FALSE] {0}'.format(command)
         else:
+            renamed = False
             if prompt is None:
+                renamed = self._hostname_change(command)
                 prompt = self.prompt
             if timeout is None:
                 timeout = self.timeout
-            result = self._send_main(command, prompt=prompt, timeout=timeout, end=end)
+            with self._span('send', command), self.limits(deadline):
+                result = self._send_main(command, prompt=prompt, timeout=timeout, end=end)
+            if renamed and self.prompt_matched:
+                self.learn_prompt()
         return result.splitlines()
 
-    def set_logging(self, filename, mode=None):
-        """Set logfile to capture terminal input and output
+    def send_iter(self, command, prompt=None, timeout=None, deadline=None):
+        """Sends a command and yields its output one line at a time.
 
-        Specify a filename to start logging.
-        Specify None to stop logging.
-        mode can be set to 'a' to append to an existing file.
-        Default mode is 'w', which will overwrite any existing file.
+        Yields the same lines send() would return, but each as soon as it
+        is complete.  Only the unfinished last line is held in data_buffer,
+        so memory stays bounded however much output the command produces,
+        and the lines can be fed straight into a parser or a file.  Stops
+        when the prompt matches, or after timeout seconds with no output.
+        A PromptTimeout raised here holds only the lines not yet yielded.
         """
-        debug_display_info(debug=self.debug)
-        if not mode == 'a':
-            mode = 'w'
-        if filename is None:
-            self.logfile = False
+        if prompt is None:
+            prompt = self.prompt
+        if timeout is None:
+            timeout = self.timeout
+        regex = compile_regex(prompt)
+        with self._span('send', command), self.limits(deadline):
+            self.write(command)
+            end_time = time.time() + timeout
+            emitted = False
+            while True:
+                offset, regex_match = self._search(regex, self._next_scan())
+                if regex_match:
+                    self.prompt_matched = True
+                    self.last_regex_match = regex_match.group()
+                    output = self.buffer.split(offset + regex_match.start())
+                    self.matched_length = len(self.last_regex_match)
+                    break
+                # Hand out complete lines, keeping the last line break,
+                # which may begin the prompt.
+                offset, text = self.buffer.tail(0)
+                cut = text.rfind(u'\n')
+                if cut > 0:
+                    output = self.buffer.split(cut)
+                    self.matched_length = max(0, self.matched_length - cut)
+                    if emitted:
+                        output = output[1:]
+                    emitted = True
+                    for line in output.splitlines():
+                        yield line
+                if not self._receive(end_time - time.time()):
+                    output = self._wait_failed(timeout)
+                    self.flush_buffer()
+                    break
+                end_time = time.time() + timeout
+            if emitted and output.startswith(u'\n'):
+                output = output[1:]
+            for line in output.splitlines():
+                yield line
+
+    def capture(self, command, path, prompt=None, timeout=None, deadline=None,
+            window=65536):
+        """Sends a command and streams its output straight into a file.
+
+        Meant for outputs too big to hold, such as show tech-support: the
+        bytes are written to path undecoded as they arrive, and only the
+        last window bytes are kept, to find the prompt, and any pager
+        prompt, at the end of the output.  The file holds what send()
+        would return, less the echoed command line.  Returns
+        CaptureResult(path, size, data), where data is a read-only mmap
+        of the file, or None if it is empty; close it when done.
+        Timeouts behave as in send(), and the file keeps what arrived.
+        """
+        if prompt is None:
+            prompt = self.prompt
+        if timeout is None:
+            timeout = self.timeout
+        prompt_regex = compile_regex(prompt.encode(self.encoding))
+        pager = None
+        if self.pager is not None:
+            pager = compile_regex(self.pager.pattern.encode(self.encoding))
+            erase = compile_regex(self.pager_erase.pattern.encode(self.encoding))
+            key = self.pager_key.encode(self.encoding)
+        erase_pending = None
+        echoed = False
+        tail = bytearray()
+        scanned = 0
+        self.buffer.clear()
+        self.matched_length = 0
+        with self._span('capture', command), self.limits(deadline), \
+                open(path, 'wb') as capture_file:
+            try:
+                self.write(command)
+                while True:
+                    data = self._read_raw(timeout)
+                    if not data:
+                        self.prompt_matched = False
+                        self._wait_failed(timeout)
+                        break
+                    self.timing.received(len(data))
+                    if erase_pending is not None:
+                        data = erase_pending + data
+                        erase_match = erase.match(data)
+                        if erase_match and erase_match.end() < len(data):
+                            data = data[erase_match.end():]
+                        elif len(data) < 64 and not data.strip(b'\b \r\x1b[K'):
+                            erase_pending = data
+                            continue
+                        erase_pending = None
+                    tail += data
+                    if not echoed:
+                        # Drop the echoed command line.
+                        cut = tail.find(b'\n')
+                        if cut < 0:
+                            continue
+                        del tail[:cut + 1]
+                        echoed = True
+                    if pager is not None:
+                        pager_match = pager.search(tail, max(0, len(tail) - 64))
+                        if pager_match:
+                            del tail[pager_match.start():]
+                            self.terminal._write(key)
+                            self.pages += 1
+                            self._count('pages')
+                            self._count('bytes_out', len(key))
+                            erase_pending = b''
+                            continue
+                    prompt_match = prompt_regex.search(tail, max(0, scanned - self.lookbehind))
+                    if prompt_match:
+                        # Keep the line break the prompt regex starts with.
+                        end = prompt_match.start()
+                        if tail[end:end + 1] in (b'\r', b'\n'):
+                            end += 1
+                        capture_file.write(tail[:end])
+                        matched = prompt_match.group().decode(self.encoding, self.errors)
+                        del tail[:]
+                        self.prompt_matched = True
+                        self.last_regex_match = matched
+                        self.data_buffer = matched
+                        self.matched_length = len(matched)
+                        break
+                    if len(tail) > 2 * window:
+                        capture_file.write(tail[:-window])
+                        del tail[:-window]
+                    scanned = len(tail)
+            finally:
+                capture_file.write(tail)
+                size = capture_file.tell()
+        if self.transcript:
+            self.transcript.write(u'[{0} bytes captured to {1}]\n'.format(size, path), '<')
+        data = None
+        if size:
+            with open(path, 'rb') as capture_file:
+                data = mmap.mmap(capture_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return CaptureResult(path, size, data)
+
+    def send_batch(self, commands, window=25, stop_on_error=True,
+            prompt=None, timeout=None, deadline=None):
+        """Sends many commands without waiting for a prompt after each one.
+
+        Commands are written window lines at a time.  The output is then
+        split on the prompts that come back, one per command, and each
+        piece is checked for the command's echo and for error_patterns.
+        Returns a list of BatchResult(command, output, error), where error
+        is the offending line of output or None.
+
+        With stop_on_error, nothing past the window holding the first error
+        is sent; commands already sent in that window still run.  A timeout
+        waiting for a prompt always stops the batch, since output can no
+        longer be matched to commands; with strict, or past deadline, it
+        raises PromptTimeout instead.
+        """
+        with self._span('batch'), self.limits(deadline):
+            return self._send_batch(commands, window, stop_on_error, prompt, timeout)
+
+    def _send_batch(self, commands, window, stop_on_error, prompt, timeout):
+        learned = prompt is None
+        renamed = False
+        if prompt is None:
+            prompt = self.prompt
+        if timeout is None:
+            timeout = self.timeout
+        error_regex = compile_regex(
+            r'^.*(?:{0}).*$'.format(r'|'.join(self.error_patterns)))
+        # Within a window each prompt is followed by the next command's echo
+        # rather than the end of the line, so the trailing $ is replaced.
+        prompt_start = re.sub(r'\$$', '', prompt)
+        commands = [command.rstrip('\r\n') for command in commands]
+        results = []
+        for index in range(0, len(commands), window):
+            block = commands[index:index + window]
+            self.write('\n'.join(block))
+            failed = False
+            for position, command in enumerate(block):
+                # Lines inside a banner do not return a prompt.
+                if self.banner and self.banner in command:
+                    self.banner = False
+                else:
+                    self._banner_start(command, timeout)
+                if self.banner:
+                    results.append(BatchResult(command, u'', None))
+                    continue
+                if learned and self._hostname_change(command):
+                    # The device shows its new name from this prompt on.
+                    renamed = True
+                    prompt = self.prompt
+                    prompt_start = re.sub(r'\$$', '', prompt)
+                if position + 1 < len(block):
+                    next_echo = block[position + 1].strip()[0:20]
+                    line_prompt = r'(?:{0})(?=\s*{1})'.format(
+                        prompt_start, re.escape(next_echo))
+                else:
+                    line_prompt = prompt
+                output = self.read_until_regex(line_prompt, timeout)
+                error = None
+                if not self.prompt_matched:
+                    error = 'Timed out waiting for prompt.'
+                elif command.strip() and command.strip()[0:20] not in output:
+                    error = 'Command echo not found.'
+                else:
+                    error_match = error_regex.search(output)
+                    if error_match:
+                        error = error_match.group().strip()
+                results.append(BatchResult(command, output, error))
+                if not self.prompt_matched:
+                    return results
+                if error:
+                    failed = True
+            if failed and stop_on_error:
+                break
+        if renamed:
+            self.learn_prompt()
+        return results
+
+    def configure(self, lines, command=None, exit_command=None, **kwargs):
+        """Pushes configuration lines with send_batch from config mode.
+
+        Enters configuration mode with command, sends lines, and always
+        leaves with exit_command.  Both default to the platform driver's
+        commands.  Keyword arguments go to send_batch.
+        """
+        if command is None:
+            command = self.driver.config_command
+        if command is None:
+            raise UserWarning('{0} has no configuration mode.'.format(self.platform))
+        if exit_command is None:
+            exit_commands = self.driver.config_exit
         else:
-            with open(filename, mode) as logfile:
-                self.logfile = filename
+            exit_commands = (exit_command,)
+        self.send(command)
+        try:
+            return self.send_batch(lines, **kwargs)
+        finally:
+            for exit_command in exit_commands:
+                self.send(exit_command)
+
+    def _command_output(self, command):
+        """Sends command and returns its output lines after the echo."""
+        lines = self.send(command)
+        for index, line in enumerate(lines):
+            if line.rstrip().endswith(command):
+                return lines[index + 1:]
+        return lines
+
+    def running_config(self, section=None):
+        """Fetches the running configuration as a ConfigBlock tree.
+
+        section limits it to the blocks matching that regex, through the
+        device's '| section' filter.
+        """
+        command = self.driver.running_config_command
+        if command is None:
+            raise UserWarning('{0} has no running configuration to parse.'
+                .format(self.platform))
+        if section:
+            command = '{0} | section {1}'.format(command, section)
+        return parse_config(self._command_output(command))
+
+    def push_config(self, desired, remove=False, section=None, **kwargs):
+        """Pushes only the commands the running configuration lacks.
+
+        desired is configuration text, a list of lines or a ConfigBlock.
+        The running configuration, or just section of it, is fetched once
+        and compared with diff_config(), and the difference is sent with
+        configure(), which receives the other keyword arguments.  Returns
+        configure()'s BatchResults; an empty list means nothing needed
+        changing.
+        """
+        commands = diff_config(self.running_config(section), desired, remove)
+        if not commands:
+            return []
+        return self.configure(commands, **kwargs)
+
+    def put_file(self, source, remote=None, method=None):
+        """Copies a local file to the device over the session's SSH transport.
+
+        source is a filename or a binary file object.  remote defaults to
+        the source's name on the driver's file_system, and method, 'scp'
+        or 'sftp', to the driver's file_transfer.  Returns the remote path
+        and the number of bytes sent.
+        """
+        if self.protocol != 'ssh' or not self.terminal:
+            raise UserWarning('put_file requires an open ssh session.')
+        if method is None:
+            method = self.driver.file_transfer
+        if method not in ('scp', 'sftp'):
+            raise ValueError('method must be scp or sftp, not {0!r}.'.format(method))
+        if isinstance(source, str):
+            if remote is None:
+                remote = self.driver.file_system + os.path.basename(source)
+            with open(source, 'rb') as source_file:
+                return self.put_file(source_file, remote, method)
+        if remote is None:
+            raise ValueError('remote is required when source is a file object.')
+        source.seek(0, io.SEEK_END)
+        size = source.tell()
+        source.seek(0)
+        with self._span('put_file', remote):
+            log.debug('%s %s bytes to %s', method, size, remote)
+            if method == 'scp':
+                self.terminal.scp_put(source, remote, size, timeout=self.timeout)
+            else:
+                sftp = self.terminal.open_sftp()
+                try:
+                    sftp.putfo(source, remote, file_size=size, confirm=False)
+                finally:
+                    sftp.close()
+        return remote, size
+
+    def _send_confirmed(self, command, timeout=None):
+        """Sends command, answering its confirmation questions with Enter."""
+        confirm = compile_regex(self.driver.confirm_prompt)
+        prompt = r'|'.join((self.prompt, self.driver.confirm_prompt))
+        output = self.send(command, prompt=prompt, timeout=timeout)
+        while self.prompt_matched and confirm.search(self.last_regex_match):
+            answer = self.send('', prompt=prompt, timeout=timeout)
+            # The question opens the answer's output: rejoin its line.
+            if output and answer:
+                output[-1] += answer.pop(0)
+            output += answer
+        return output
 
-    def write_to_log(self, output, prefix=None):
-        """Writes string to the current logging file if logging is enabled
-        
-        Accepts a string.
-        Used internally, but useful for inserting debug comments.
+    def deploy_config(self, config, name='pyvty.cfg', method=None, cleanup=True,
+            timeout=None, deadline=None):
+        """Pushes configuration as a file: one transfer and one command.
+
+        For large changes this replaces a round trip per line.  config is
+        configuration text, a list of lines or a ConfigBlock.  It is
+        copied with put_file() to name on the driver's file_system,
+        applied with the driver's load_command, and deleted again if
+        cleanup.  Returns DeployResult(path, size, output, errors), where
+        output is the lines the device printed while applying and
+        committing the file and errors those matching error_patterns.
         """
-        if prefix is None:
-            prefix = str(datetime.datetime.fromtimestamp(time.time()))
-        if self.logfile:
-            with open(self.logfile, 'a') as logfile:
-                logfile.write(prefix + output)
-                return True
-        return False
+        if self.driver.load_command is None:
+            raise UserWarning('{0} cannot load configuration from a file.'
+                .format(self.platform))
+        if isinstance(config, ConfigBlock):
+            config = str(config)
+        elif not isinstance(config, str):
+            config = u'\n'.join(line.rstrip('\r\n') for line in config)
+        path, size = self.put_file(io.BytesIO((config + u'\n').encode(self.encoding)),
+            self.driver.file_system + name, method)
+        load_command = self.driver.load_command.format(path)
+        with self.limits(deadline):
+            if self.driver.load_in_config:
+                self.send(self.driver.config_command)
+                output = []
+                try:
+                    output += self._send_confirmed(load_command, timeout)
+                finally:
+                    for exit_command in self.driver.config_exit:
+                        output += self._send_confirmed(exit_command, timeout)
+            else:
+                output = self._send_confirmed(load_command, timeout)
+            if cleanup and self.driver.delete_command:
+                self._send_confirmed(self.driver.delete_command.format(path), timeout)
+        error_regex = compile_regex(r'|'.join(self.error_patterns))
+        errors = [line.strip() for line in output if error_regex.search(line)]
+        return DeployResult(path, size, output, errors)
+
+    def exec_commands(self, commands, channels=4, timeout=None):
+        """Runs commands over SSH exec channels, several at once.
+
+        Each command gets its own channel on the session's SSH transport,
+        up to channels at a time, and its output ends at channel EOF, so
+        no prompt matching or echo stripping is involved.  This suits
+        read-only show commands on devices that accept exec requests.
+        Returns a list of ExecResult(command, output, status, error) in the
+        order given, where status is the exit status if the device sent
+        one and error is set when a command timed out.
+        """
+        if self.protocol != 'ssh' or not self.terminal:
+            raise UserWarning('exec_commands requires an open ssh session.')
+        if timeout is None:
+            timeout = self.timeout
+        commands = list(commands)
+        results = [None] * len(commands)
+        pending = collections.deque(enumerate(commands))
+        selector = selectors.DefaultSelector()
+        try:
+            while pending or selector.get_map():
+                while pending and len(selector.get_map()) < channels:
+                    index, command = pending.popleft()
+                    self._log_input(command)
+                    channel = self.terminal.exec_channel(command)
+                    selector.register(channel, selectors.EVENT_READ, (
+                        index, command, [],
+                        codecs.getincrementaldecoder(self.encoding)(self.errors),
+                        time.time() + timeout))
+                now = time.time()
+                wait = min(key.data[4] for key in selector.get_map().values()) - now
+                selector.select(max(wait, 0))
+                for key in list(selector.get_map().values()):
+                    channel = key.fileobj
+                    index, command, output, decoder, end_time = key.data
+                    # Check EOF first: output that arrives with it is then
+                    # still drained below, never left unread.
+                    at_eof = channel.eof_received or channel.closed
+                    while channel.recv_ready():
+                        output.append(decoder.decode(channel.recv(65536)))
+                    if not at_eof and time.time() < end_time:
+                        continue
+                    selector.unregister(channel)
+                    output.append(decoder.decode(b'', True))
+                    error = None
+                    status = None
+                    if at_eof:
+                        # The exit status usually follows EOF closely.
+                        channel.status_event.wait(1)
+                        if channel.exit_status_ready() and channel.exit_status >= 0:
+                            status = channel.exit_status
+                    else:
+                        log.debug('exec timeout: %s', command)
+                        error = 'Timed out waiting for command to complete.'
+                    channel.close()
+                    output = u''.join(output)
+                    if self.transcript:
+                        self.transcript.write(output, '<')
+                    results[index] = ExecResult(command, output, status, error)
+        finally:
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+            selector.close()
+        return results
+
+    def send_bytes(self, command, prompt=None, timeout=None):
+        """Sends a command and returns its output as undecoded bytes.
+
+        Output goes from the transport into a bytes buffer without passing
+        through the decoder, which suits bulk captures and output that is
+        not valid text.  prompt and timeout work as they do for send().
+        """
+        if prompt is None:
+            prompt = self.prompt
+        if timeout is None:
+            timeout = self.timeout
+        with self._bytes_mode():
+            return self._send_main(command, prompt=prompt, timeout=timeout, end='\n')
 
 
 class SSH(object):
@@ -581,7 +2784,6 @@ class SSH(object):
     # by the library user.
     def __init__(self, host, **kwargs):
         self.debug = kwargs.get('debug', 0)
-        debug_display_info(debug=self.debug)
         self.terminal_exceptions = (
             socket.timeout,
             socket.error,
@@ -589,6 +2791,7 @@ class SSH(object):
             paramiko.AuthenticationException,
             paramiko.SSHException,
             )
+        shell = kwargs.pop('shell', True)
         kwargs['look_for_keys'] = False  # Fix auth error due to private keys.
         kwargs['allow_agent'] = False    # Fix auth error from fedora desktop.
         if not 'timeout' in kwargs:
@@ -600,16 +2803,16 @@ class SSH(object):
         except KeyError as exception:
             print('Missing required argument: {0}'.format(exception),
                     file=sys.stderr)
-        debug_display_info(debug=self.debug,
-            message="SSH to host {0} : {1}".format(host, port))
+        log.debug('SSH to host %s : %s', host, port)
         self.client = paramiko.SSHClient()
         self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self.client.connect(host, **kwargs)
-        self.terminal = self.client.invoke_shell()
+        self.terminal = None
+        if shell:
+            self.terminal = self.client.invoke_shell()
 
     def _close(self):
         """Properly close connection to network device."""
-        debug_display_info(debug=self.debug)
         if self.client:
             try:
                 self.client.close()
@@ -618,67 +2821,1142 @@ class SSH(object):
                 print("terminal_close_exception: %s" % str(terminal_exception), file=sys.stderr)  ###
                 return False
 
-    def _read(self):
-        """Internal method to get output from SSH session."""
-        debug_display_info(debug=self.debug)
-        read_buffer = bytes()
+    def fileno(self):
+        """Returns a descriptor that becomes readable when output arrives."""
+        return self.terminal.fileno()
+
+    def _at_eof(self):
+        """Returns True once the remote end has closed the session."""
+        return self.terminal.closed or self.terminal.eof_received
+
+    def _read(self, max_size=262144):
+        """Internal method to get up to max_size output bytes from SSH session."""
+        read_buffer = []
+        size = 0
         try:
-            while self.terminal.recv_ready():
-                read_buffer += self.terminal.recv(16384)
-            return read_buffer.decode()
+            while size < max_size and self.terminal.recv_ready():
+                read_buffer.append(self.terminal.recv(16384))
+                size += len(read_buffer[-1])
+            return b''.join(read_buffer)
         except self.terminal_exceptions as terminal_exception:
             print("terminal_read_exception: %s" % str(terminal_exception), file=sys.stderr)   ###
-            return str(terminal_exception)
+            return str(terminal_exception).encode()
 
-    def _write(self, text):
-        """Internal method to write string to SSH session."""
-        debug_display_info(debug=self.debug)
+    def _write(self, data):
+        """Internal method to write bytes to SSH session."""
         try:
             # send a command to shell and get output back
-            self.terminal.send(text)
+            self.terminal.sendall(data)
             return True
         except self.terminal_exceptions as terminal_exception:
             print("terminal_write_exception: %s" % str(terminal_exception), file=sys.stderr)   ###
             return False
 
+    def exec_channel(self, command):
+        """Opens a new channel on the SSH transport that runs command.
+
+        The channel carries only that command's output, stderr included,
+        and reaches EOF when the command completes.
+        """
+        channel = self.client.get_transport().open_session()
+        channel.set_combine_stderr(True)
+        channel.exec_command(command)
+        return channel
+
+    def open_sftp(self):
+        """Opens an SFTP session on the SSH transport."""
+        return self.client.open_sftp()
+
+    def _scp_ack(self, channel):
+        reply = channel.recv(1)
+        if reply == b'\0':
+            return
+        message = b''
+        while reply and not message.endswith(b'\n'):
+            reply = channel.recv(1)
+            message += reply
+        raise UserWarning('scp: {0}'.format(
+            message.decode('utf-8', 'replace').strip() or 'connection closed'))
+
+    def scp_put(self, source, remote, size, mode=0o644, timeout=30):
+        """Copies size bytes from file object source to remote with SCP.
+
+        Runs 'scp -t remote' on an exec channel of the SSH transport and
+        plays the sending side of the protocol.
+        """
+        channel = self.client.get_transport().open_session()
+        channel.settimeout(timeout)
+        try:
+            channel.exec_command('scp -t {0}'.format(remote))
+            self._scp_ack(channel)
+            name = re.split(r'[:/]', remote)[-1]
+            channel.sendall('C{0:04o} {1} {2}\n'.format(mode, size, name).encode('utf-8'))
+            self._scp_ack(channel)
+            remaining = size
+            while remaining > 0:
+                chunk = source.read(min(remaining, 32768))
+                if not chunk:
+                    raise UserWarning('scp: {0} ended early.'.format(remote))
+                channel.sendall(chunk)
+                remaining -= len(chunk)
+            channel.sendall(b'\0')
+            self._scp_ack(channel)
+        finally:
+            channel.close()
+
 
 class Telnet(object):
-    """Uses Telnet protocol to access network device terminal."""
+    """Uses Telnet protocol to access network device terminal.
+
+    Talks telnet directly on a non-blocking socket.  Output is received
+    with recv_into into one reusable buffer and passed through
+    TelnetCodec, which strips and answers option negotiation, including
+    a wide NAWS window size so devices do not wrap long lines.
+    """
 
     def __init__(self, host, **kwargs):
         self.debug = kwargs.get('debug', 0)
-        debug_display_info(debug=self.debug)
         try:
             port = int(kwargs['port'])
             username = kwargs['username']
             password = kwargs['password']
-            debug_display_info(debug=self.debug,
-                message="Telnet to host {0} : {1}".format(host, port))
-            self.terminal = telnetlib.Telnet(host, port)
         except KeyError as exception:
             raise KeyError('Missing required argument: {}'.format(exception))
+        log.debug('Telnet to host %s : %s', host, port)
+        self.timeout = kwargs.get('timeout', 7)
+        self.connection = socket.create_connection((host, port), self.timeout)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connection.setblocking(False)
+        self.codec = TelnetCodec()
+        self.read_buffer = bytearray(65536)
+        self.read_view = memoryview(self.read_buffer)
+        self.eof = False
+        self._send(self.codec.start())
 
     def _close(self):
         """Properly close connection to network device."""
-        debug_display_info(debug=self.debug)
         try:
-            self.terminal.close()
-        except exceptions as exception:
-            debug_display_info(debug=self.debug,
-                message="terminal_close_exception: {0}".format(exception))
+            self.connection.close()
+            return True
+        except socket.error as exception:
+            log.debug('terminal_close_exception: %s', exception)
             return False
 
+    def fileno(self):
+        """Returns the telnet socket, readable when output arrives."""
+        return self.connection.fileno()
+
+    def _at_eof(self):
+        """Returns True once the remote end has closed the session."""
+        return self.eof
+
+    def _read(self, max_size=262144):
+        """Internal method to get up to max_size output bytes from Telnet session."""
+        chunks = []
+        size = 0
+        while size < max_size:
+            try:
+                count = self.connection.recv_into(self.read_buffer)
+            except (BlockingIOError, InterruptedError):
+                break
+            except socket.error as exception:
+                log.debug('terminal_read_exception: %s', exception)
+                self.eof = True
+                break
+            if not count:
+                self.eof = True
+                break
+            chunks.append(self.read_view[:count].tobytes())
+            size += count
+        if not chunks:
+            return b''
+        output, reply = self.codec.feed(b''.join(chunks))
+        if reply:
+            self._send(reply)
+        return output
+
+    def _send(self, data):
+        if not data:
+            return
+        # sendall on a socket with a timeout waits for buffer space.
+        self.connection.settimeout(self.timeout)
+        try:
+            self.connection.sendall(data)
+        finally:
+            self.connection.setblocking(False)
+
+    def _write(self, data):
+        """Internal method to send bytes to Telnet session."""
+        try:
+            self._send(data.replace(bytes((IAC,)), bytes((IAC, IAC))))
+            return True
+        except socket.error as exception:
+            log.debug('terminal_write_exception: %s', exception)
+            return False
+
+
+IAC = 255   # telnet "interpret as command"
+DONT = 254
+DO = 253
+WONT = 252
+WILL = 251
+SB = 250    # subnegotiation begin
+SE = 240    # subnegotiation end
+ECHO = 1
+SGA = 3     # suppress go ahead
+NAWS = 31   # negotiate about window size
+
+
+class Recorder(object):
+    """Wraps an SSH or Telnet transport and records the session to a file.
+
+    Every chunk read and written goes into a records-format transcript
+    as bytes decoded with latin-1, so read_transcript() can read it and
+    Replay can play it back.  Writes matching one of secrets, such as
+    the password, are recorded as asterisks.
+    """
+
+    def __init__(self, transport, filename, info=None, secrets=()):
+        self.transport = transport
+        self.secrets = secrets
+        self.writer = TranscriptWriter(filename, 'w', format='records')
+        self.writer.write(json.dumps(info or {}), '#')
+
+    def fileno(self):
+        return self.transport.fileno()
+
+    def _at_eof(self):
+        return self.transport._at_eof()
+
+    def _read(self):
+        data = self.transport._read()
+        if data:
+            self.writer.write(data.decode('latin-1'), '<')
+        return data
+
+    def _write(self, data):
+        text = data.decode('latin-1')
+        if text.rstrip('\r\n') in self.secrets:
+            text = u'********' + text[len(text.rstrip('\r\n')):]
+        self.writer.write(text, '>')
+        return self.transport._write(data)
+
+    def exec_channel(self, command):
+        """Exec channels are passed through unrecorded."""
+        return self.transport.exec_channel(command)
+
+    def open_sftp(self):
+        """File transfers are passed through unrecorded."""
+        return self.transport.open_sftp()
+
+    def scp_put(self, *args, **kwargs):
+        return self.transport.scp_put(*args, **kwargs)
+
+    def _close(self):
+        try:
+            return self.transport._close()
+        finally:
+            self.writer.close()
+
+
+class Replay(object):
+    """Plays back a session recorded by Recorder in place of SSH or Telnet.
+
+    Output is fed through a socket pair, so Terminal waits on it exactly
+    as it waits on a network session.  Output recorded after a write is
+    held back until the Terminal makes that write; speed=1.0 keeps the
+    recorded timing, 2.0 runs twice as fast, and None plays the output as
+    fast as it can be read.  Writes that differ from the recording are
+    logged as warnings.
+    """
+
+    def __init__(self, filename, speed=1.0):
+        self.speed = speed
+        self.records = []
+        self.info = {}
+        for epoch, direction, text in read_transcript(filename):
+            if direction == '#' and not self.records and not self.info:
+                self.info = json.loads(text)
+            elif direction in ('<', '>'):
+                self.records.append((epoch, direction, text.encode('latin-1')))
+        self.expected = collections.deque(
+            data for epoch, direction, data in self.records if direction == '>')
+        self.writes = threading.Semaphore(0)
+        self.closed = threading.Event()
+        self.local, self.remote = socket.socketpair()
+        self.local.setblocking(False)
+        self.eof = False
+        self.feeder = threading.Thread(target=self._feed, name='pyvty-replay')
+        self.feeder.daemon = True
+        self.feeder.start()
+
+    @staticmethod
+    def session_info(filename):
+        """Returns the host, port and protocol a recording was made with."""
+        for epoch, direction, text in read_transcript(filename):
+            if direction == '#':
+                return json.loads(text)
+            break
+        return {}
+
+    def _feed(self):
+        """Sends recorded output to the Terminal's end of the socket pair."""
+        try:
+            clock_start = time.time()
+            record_start = self.records[0][0] if self.records else 0
+            for epoch, direction, data in self.records:
+                if direction == '>':
+                    while not self.writes.acquire(timeout=0.5):
+                        if self.closed.is_set():
+                            return
+                    # Output after a write is timed from when the write happens.
+                    clock_start = time.time()
+                    record_start = epoch
+                    continue
+                if self.speed:
+                    delay = (epoch - record_start) / self.speed - \
+                        (time.time() - clock_start)
+                    if delay > 0 and self.closed.wait(delay):
+                        return
+                if self.closed.is_set():
+                    return
+                self.remote.sendall(data)
+        except socket.error:
+            pass
+        finally:
+            self.remote.close()
+
+    def fileno(self):
+        return self.local.fileno()
+
+    def _at_eof(self):
+        return self.eof
+
     def _read(self):
-        """Internal method to get output from Telnet session."""
-        ### ADD EXCEPTION ###
-        debug_display_info(debug=self.debug)
-        read_buffer = self.terminal.read_very_eager()
-        return read_buffer.decode()
-
-    def _write(self, text):
-        """Internal method to send string to Telnet session."""
-        ### ADD EXCEPTION ###
-        debug_display_info(debug=self.debug)
-        self.terminal.write(text.encode())
+        read_buffer = []
+        try:
+            while True:
+                data = self.local.recv(262144)
+                if not data:
+                    self.eof = True
+                    break
+                read_buffer.append(data)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except socket.error:
+            self.eof = True
+        return b''.join(read_buffer)
+
+    def _write(self, data):
+        if self.expected:
+            expected = self.expected.popleft()
+            if data != expected and not expected.startswith(b'********'):
+                log.warning('replay input %r differs from recorded %r',
+                    data, expected)
+        self.writes.release()
+        return True
+
+    def _close(self):
+        self.closed.set()
+        self.local.close()
         return True
 
+
+class TelnetCodec(object):
+    """Separates terminal output from telnet commands in a byte stream.
+
+    Lets the server echo and suppress go-ahead, reports a window of
+    window=(width, height) characters through NAWS, and refuses every
+    other option.  State is kept between calls to feed(), so a command
+    split across two reads is still recognised.
+    """
+
+    def __init__(self, window=(511, 0)):
+        self.pending = b''
+        self.subnegotiation = False
+        self.window = window
+        self.local = set()      # options we have offered or agreed to
+        self.remote = set()     # options the server has been told to use
+
+    def start(self):
+        """Returns the negotiation to send as the session opens."""
+        if self.window is None:
+            return b''
+        self.local.add(NAWS)
+        return bytes((IAC, WILL, NAWS))
+
+    def _window_size(self):
+        size = struct.pack('>HH', *self.window).replace(bytes((IAC,)), bytes((IAC, IAC)))
+        return bytes((IAC, SB, NAWS)) + size + bytes((IAC, SE))
+
+    def _negotiate(self, verb, option, reply):
+        if verb == DO:
+            if option == NAWS and self.window is not None:
+                if option not in self.local:
+                    reply.append(bytes((IAC, WILL, option)))
+                self.local.add(option)
+                reply.append(self._window_size())
+            elif option == SGA:
+                if option not in self.local:
+                    reply.append(bytes((IAC, WILL, option)))
+                self.local.add(option)
+            else:
+                reply.append(bytes((IAC, WONT, option)))
+        elif verb == DONT:
+            self.local.discard(option)
+        elif verb == WILL:
+            if option in (ECHO, SGA):
+                if option not in self.remote:
+                    reply.append(bytes((IAC, DO, option)))
+                self.remote.add(option)
+            else:
+                reply.append(bytes((IAC, DONT, option)))
+        elif verb == WONT:
+            self.remote.discard(option)
+
+    def feed(self, data):
+        """Returns (output, reply) for a chunk of raw bytes from the socket.
+
+        output is the terminal text with telnet commands removed.
+        reply holds the negotiation that must be written back.
+        """
+        if not self.pending and not self.subnegotiation and IAC not in data:
+            return data.replace(b'\x00', b''), b''
+        data = self.pending + data
+        self.pending = b''
+        output = []
+        reply = []
+        index = 0
+        length = len(data)
+        while index < length:
+            if self.subnegotiation:
+                end = data.find(bytes((IAC, SE)), index)
+                if end < 0:
+                    if data.endswith(bytes((IAC,))):
+                        self.pending = bytes((IAC,))
+                    break
+                self.subnegotiation = False
+                index = end + 2
+                continue
+            command = data.find(bytes((IAC,)), index)
+            if command < 0:
+                output.append(data[index:])
+                break
+            output.append(data[index:command])
+            if command + 1 >= length:
+                self.pending = data[command:]
+                break
+            verb = data[command + 1]
+            if verb == IAC:
+                output.append(bytes((IAC,)))
+                index = command + 2
+            elif verb in (DO, DONT, WILL, WONT):
+                if command + 2 >= length:
+                    self.pending = data[command:]
+                    break
+                self._negotiate(verb, data[command + 2], reply)
+                index = command + 3
+            elif verb == SB:
+                self.subnegotiation = True
+                index = command + 2
+            else:
+                index = command + 2
+        return b''.join(output).replace(b'\x00', b''), b''.join(reply)
+
+
+class AsyncSSH(object):
+    """Drives an SSH session from an asyncio event loop.
+
+    Connection setup runs the blocking SSH class in the default executor.
+    Reads wait on the channel's descriptor with loop.add_reader, so a
+    session waiting for output does not hold a thread of its own.
+    """
+
+    def __init__(self, ssh):
+        self.ssh = ssh
+
+    @classmethod
+    async def open(cls, host, **kwargs):
+        loop = asyncio.get_event_loop()
+        ssh = await loop.run_in_executor(None, functools.partial(SSH, host, **kwargs))
+        return cls(ssh)
+
+    @staticmethod
+    def _wake(waiter):
+        if not waiter.done():
+            waiter.set_result(True)
+
+    async def _readable(self):
+        """Waits until the channel has output or has been closed."""
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+        fileno = self.ssh.fileno()
+        loop.add_reader(fileno, self._wake, waiter)
+        try:
+            await waiter
+        finally:
+            loop.remove_reader(fileno)
+
+    def _at_eof(self):
+        return self.ssh._at_eof()
+
+    def _close(self):
+        return self.ssh._close()
+
+    async def _read(self):
+        """Waits for output from SSH session.  Returns b'' at end of session."""
+        while True:
+            received_data = self.ssh._read()
+            if received_data or self.ssh._at_eof():
+                return received_data
+            await self._readable()
+
+    async def _write(self, data):
+        # sendall blocks while the channel window is full, so it runs in
+        # the executor rather than stalling every session on the loop.
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.ssh._write, data)
+
+
+class AsyncTelnet(object):
+    """Uses Telnet protocol over an asyncio stream to access network device terminal."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.codec = TelnetCodec()
+        self.eof = False
+
+    @classmethod
+    async def open(cls, host, **kwargs):
+        try:
+            port = int(kwargs['port'])
+        except KeyError as exception:
+            raise KeyError('Missing required argument: {}'.format(exception))
+        reader, writer = await asyncio.open_connection(host, port)
+        terminal = cls(reader, writer)
+        writer.write(terminal.codec.start())
+        return terminal
+
+    def _at_eof(self):
+        return self.eof
+
+    def _close(self):
+        self.writer.close()
+        return True
+
+    async def _read(self):
+        """Waits for output from Telnet session.  Returns b'' at end of session."""
+        while True:
+            read_buffer = await self.reader.read(16384)
+            if not read_buffer:
+                self.eof = True
+                return b''
+            output, reply = self.codec.feed(read_buffer)
+            if reply:
+                self.writer.write(reply)
+            if output:
+                return output
+
+    async def _write(self, data):
+        self.writer.write(data.replace(bytes((IAC,)), bytes((IAC, IAC))))
+        await self.writer.drain()
+        return True
+
+
+class AsyncTerminal(BaseTerminal):
+    """asyncio counterpart of Terminal.
+
+    Methods that talk to the device are coroutines, so a single event loop
+    can drive many sessions at once:
+
+        terminal = pyvty.AsyncTerminal(host, username=u, password=p)
+        await terminal.connect()
+        output = await terminal.send('show version')
+        await terminal.close()
+
+    "async with pyvty.AsyncTerminal(...) as terminal:" connects and closes.
+    Prompt matching and banner handling are shared with Terminal.
+    """
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def connect(self):
+        if self.terminal:
+            return False
+        loop = asyncio.get_event_loop()
+        self.protocol, self.port = await loop.run_in_executor(None,
+            determine_protocol, self.host, self.protocol, self.port,
+            self.kwargs.get('reachability'))
+        hostdict = {
+            'port':self.port,
+            'username':self.username,
+            'password':self.password,
+            }
+        if self.protocol is None:
+            raise socket.error('Cannot connect to host via ssh or telnet.')
+        self._connecting()
+        with self._span('connect', self.host):
+            if self.protocol == 'ssh':
+                self.terminal = await AsyncSSH.open(self.host, **hostdict)
+            elif self.protocol == 'telnet':
+                self.terminal = await AsyncTelnet.open(self.host, **hostdict)
+        if self.protocol == 'telnet':
+            await self.login(self.username, self.password)
+        else:
+            await self.read_until_regex(self.prompt)
+        self.learn_prompt()
+        if self.driver.enable_command:
+            await self.enable_privilege(self.driver.enable_command)
+        if self.disable_paging:
+            await self.send(self.disable_paging)
+        return True
+
+    async def close(self):
+        if self.terminal:
+            self.terminal._close()
+            self.terminal = None
+        self._close_transcript()
+
+    async def login(self, username, password):
+        """Login to terminal session.  Requires username, password."""
+        with self._span('login', self.host):
+            await self.read_until_regex(r'|'.join((self.prompt, self.login_prompt)))
+            if compile_regex(self.prompt).search(self.last_regex_match):
+                return True
+            await self.write(username)
+            await self.read_until_regex(self.password_prompt)
+            await self.write(password)
+            await self.read_until_regex(
+                r'|'.join((self.prompt, self.login_prompt, self.auth_fail)))
+            if compile_regex(r'|'.join((self.login_prompt, self.auth_fail))).search(
+                    self.last_regex_match):
+                raise UserWarning('Authentication Failed')
+
+    async def enable_privilege(self, command="enable", password=None):
+        """Elevate privilege level from read-only to read-write.
+
+        By default, uses the same password that was used at login.
+        """
+        with self._span('enable', self.host):
+            if password is None:
+                password = self.password
+            self.secrets.add(password)
+            await self.write(command)
+            await self.read_until_regex(self.enable_prompt)
+            while re.search(r'[Pp]assword:? ?$', self.last_regex_match):
+                await self.write(password)
+                await self.read_until_regex(self.enable_prompt)
+            if re.search(r'# ?$', self.last_regex_match):
+                return True
+            return False
+
+    async def _receive(self, timeout):
+        """Waits up to timeout seconds for output and appends it to data_buffer."""
+        end_time = time.time() + timeout
+        while True:
+            self._check_limits()
+            start_time = time.time()
+            try:
+                received_data = await asyncio.wait_for(
+                    self.terminal._read(), self._wait_slice(end_time))
+            except asyncio.TimeoutError:
+                self._count('wait_seconds', time.time() - start_time)
+                if time.time() < end_time:
+                    continue
+                return False
+            self._count('wait_seconds', time.time() - start_time)
+            if not received_data:
+                return False
+            start_time = time.time()
+            self._count('bytes_in', len(received_data))
+            self._append(received_data)
+            if self.pager is not None and self.decoder is not None:
+                key = self._page()
+                if key:
+                    await self.terminal._write(key)
+                    self._count('bytes_out', len(key))
+            self._count('receive_seconds', time.time() - start_time)
+            return True
+
+    async def read_until(self, match, timeout=None):
+        """This will match a pattern, return text before the first match."""
+        if timeout is None:
+            timeout = self.timeout
+        end_time = time.time() + timeout
+        start = 0
+        while True:
+            output = self._take_match(match, start)
+            if output is not None:
+                return output
+            start = self._next_scan(match)
+            if not await self._receive(end_time - time.time()):
+                break
+            end_time = time.time() + timeout
+        return self._wait_failed(timeout)
+
+    async def read_until_regex(self, match, timeout=None):
+        """This will match a regular expression.
+
+        Return everything before the first regex match.
+        self.last_regex_match is assigned the string matching the regex.
+        Timeout counter is reset whenever new data appears on terminal.
+        """
+        with self._span('prompt_wait', match):
+            if timeout is None:
+                timeout = self.timeout
+            end_time = time.time() + timeout
+            regex = compile_regex(match)
+            start = 0
+            while True:
+                output = self._take_regex_match(regex, start)
+                if output is not None:
+                    return output
+                start = self._next_scan()
+                if not await self._receive(end_time - time.time()):
+                    break
+                end_time = time.time() + timeout
+            return self._wait_failed(timeout)
+
+    async def write(self, text, end='\n'):
+        """Sends string to terminal with trailing newline."""
+        self._log_input(text)
+        data = (text + end).encode(self.encoding)
+        result = await self.terminal._write(data)
+        self._count('bytes_out', len(data))
+        self.timing.sent()
+        await asyncio.sleep(self.send_delay)
+        return result
+
+    async def send(self, command, prompt=None, timeout=None, send=True,
+            deadline=None):
+        """Sends a command to the terminal and waits for the prompt to return.
+
+        Returns a list of output lines, as Terminal.send does, and takes
+        the same deadline.
+        """
+        if not send:
+            return '[SEND=FALSE] {0}'.format(command).splitlines()
+        renamed = False
+        if prompt is None:
+            renamed = self._hostname_change(command)
+            prompt = self.prompt
+        if timeout is None:
+            timeout = self.timeout
+        timeout = self._banner_start(command, timeout)
+        with self._span('send', command), self.limits(deadline):
+            result = await self._send_main(command, prompt, timeout)
+        if renamed and self.prompt_matched:
+            self.learn_prompt()
+        return result
+
+    async def _send_main(self, command, prompt, timeout):
+        await self.write(command)
+        result = u''
+        if command != '':
+            retained = self.matched_length
+            try:
+                result = await self.read_until(command.splitlines()[0][0:20], timeout=3)
+            except PromptTimeout as error:
+                if error.reason != 'idle':
+                    raise
+                self.data_buffer = error.output
+                self.matched_length = retained
+        try:
+            result += await self.read_until_regex(prompt, timeout)
+        except (PromptTimeout, ConnectionLost) as error:
+            error.output = result + error.output
+            raise
+        self._banner_finish(command)
+        return result.splitlines()
+
+
+class TerminalPool(object):
+    """Keeps authenticated, enabled Terminals open for reuse across jobs.
+
+        pool = pyvty.TerminalPool(username=u, password=p)
+        with pool.session(host) as terminal:
+            terminal.send('show version')
+
+    Sessions are keyed by host, port, protocol, platform, username and a
+    digest of the password, so only a caller giving the same credentials
+    is handed a session someone else logged in.  checkout()
+    hands out an idle session for the key after probing it for a prompt,
+    or connects a new one.  Idle sessions get a keepalive probe every
+    keepalive seconds and are closed after idle_ttl seconds unused; None
+    turns either off.  max_size bounds all open sessions and max_per_host those to one host;
+    when the pool is full the least recently used idle session is closed
+    to make room, otherwise checkout() waits up to wait_timeout seconds.
+    Other keyword arguments are passed to every Terminal.
+    """
+
+    def __init__(self, max_size=64, max_per_host=2, idle_ttl=300,
+            keepalive=60, probe_timeout=5, wait_timeout=None, **kwargs):
+        self.max_size = max_size
+        self.max_per_host = max_per_host
+        self.idle_ttl = idle_ttl
+        self.keepalive = keepalive
+        self.probe_timeout = probe_timeout
+        self.wait_timeout = wait_timeout
+        self.kwargs = kwargs
+        self.idle = collections.OrderedDict()   # terminal -> (key, last_used, last_probe)
+        self.keys = {}                          # terminal -> key, open sessions
+        self.condition = threading.Condition()
+        self.closed = False
+        self.keeper = None
+        if keepalive or idle_ttl:
+            self.keeper = threading.Thread(target=self._keep_alive, name='pyvty-pool')
+            self.keeper.daemon = True
+            self.keeper.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _key(self, host, port, protocol, kwargs):
+        password = kwargs.get('password')
+        if password is not None:
+            password = hashlib.sha256(password.encode('utf-8')).hexdigest()
+        return (host, port, protocol, kwargs.get('platform'),
+            kwargs.get('username'), password)
+
+    def _host_count(self, host):
+        return sum(1 for key in self.keys.values() if key[0] == host)
+
+    def _idle_session(self, key):
+        """Removes and returns the most recently used idle session for key."""
+        for terminal in reversed(self.idle):
+            if self.idle[terminal][0] == key:
+                del self.idle[terminal]
+                return terminal
+        return None
+
+    def _evict_lru(self, host=None):
+        """Removes and returns the least recently used idle session."""
+        for terminal in self.idle:
+            if host is None or self.keys[terminal][0] == host:
+                del self.idle[terminal]
+                del self.keys[terminal]
+                return terminal
+        return None
+
+    def _discard(self, terminal):
+        try:
+            terminal.close()
+        except Exception as exception:
+            log.debug('pool close exception: %s', exception)
+
+    def _probe(self, terminal):
+        """Returns True if the session still answers with a prompt."""
+        try:
+            terminal.send('', timeout=self.probe_timeout)
+            return terminal.prompt_matched
+        except Exception as exception:
+            log.debug('pool probe exception: %s', exception)
+            return False
+
+    def checkout(self, host, port=None, protocol=None, **kwargs):
+        """Returns a ready Terminal for host, reusing an idle one if possible."""
+        options = dict(self.kwargs)
+        options.update(kwargs)
+        key = self._key(host, port, protocol, options)
+        end_time = None
+        if self.wait_timeout is not None:
+            end_time = time.time() + self.wait_timeout
+        while True:
+            evicted = None
+            placeholder = object()
+            with self.condition:
+                if self.closed:
+                    raise UserWarning('TerminalPool is closed.')
+                terminal = self._idle_session(key)
+                if terminal is None:
+                    if self._host_count(host) >= self.max_per_host:
+                        evicted = self._evict_lru(host)
+                    elif len(self.keys) >= self.max_size:
+                        evicted = self._evict_lru()
+                    else:
+                        evicted = False
+                    if evicted is None:
+                        remaining = None
+                        if end_time is not None:
+                            remaining = end_time - time.time()
+                            if remaining <= 0:
+                                raise socket.timeout(
+                                    'No session available for {0}.'.format(host))
+                        self.condition.wait(remaining)
+                        continue
+                    # Hold the slot while connecting, so that concurrent
+                    # checkouts count this session too.
+                    self.keys[placeholder] = key
+            if terminal is not None:
+                if self._probe(terminal):
+                    return terminal
+                log.debug('pool session to %s failed probe', host)
+                with self.condition:
+                    del self.keys[terminal]
+                    self.condition.notify_all()
+                self._discard(terminal)
+                continue
+            if evicted:
+                self._discard(evicted)
+            terminal = None
+            try:
+                terminal = Terminal(host, port=port, protocol=protocol, **options)
+            finally:
+                with self.condition:
+                    del self.keys[placeholder]
+                    if terminal is not None:
+                        self.keys[terminal] = key
+                    self.condition.notify_all()
+            return terminal
+
+    def checkin(self, terminal, discard=False):
+        """Returns a Terminal to the pool, or closes it if discard is True."""
+        with self.condition:
+            if discard or self.closed or terminal not in self.keys \
+                    or not terminal.terminal:
+                self.keys.pop(terminal, None)
+                discard = True
+            else:
+                now = time.time()
+                self.idle[terminal] = (self.keys[terminal], now, now)
+            self.condition.notify_all()
+        if discard:
+            self._discard(terminal)
+
+    @contextlib.contextmanager
+    def session(self, host, port=None, protocol=None, **kwargs):
+        """Checks a Terminal out for the duration of a with block.
+
+        The Terminal is discarded rather than reused if the block raises,
+        since its state is then unknown.
+        """
+        terminal = self.checkout(host, port, protocol, **kwargs)
+        try:
+            yield terminal
+        except BaseException:
+            self.checkin(terminal, discard=True)
+            raise
+        self.checkin(terminal)
+
+    def _keep_alive(self):
+        """Probes idle sessions and closes those idle past idle_ttl."""
+        interval = max(1, min(self.keepalive or self.idle_ttl,
+            self.idle_ttl or self.keepalive) / 2.0)
+        while True:
+            with self.condition:
+                self.condition.wait(interval)
+                if self.closed:
+                    return
+                now = time.time()
+                expired = []
+                stale = []
+                for terminal, (key, last_used, last_probe) in list(self.idle.items()):
+                    if self.idle_ttl and now - last_used >= self.idle_ttl:
+                        expired.append(terminal)
+                        del self.idle[terminal]
+                        del self.keys[terminal]
+                    elif self.keepalive and now - last_probe >= self.keepalive:
+                        stale.append((terminal, key, last_used))
+                        del self.idle[terminal]
+                if expired:
+                    self.condition.notify_all()
+            for terminal in expired:
+                log.debug('pool closing idle session to %s', terminal.host)
+                self._discard(terminal)
+            for terminal, key, last_used in stale:
+                healthy = self._probe(terminal)
+                with self.condition:
+                    if healthy and not self.closed:
+                        self.idle[terminal] = (key, last_used, time.time())
+                        self.idle.move_to_end(terminal, last=False)
+                    else:
+                        del self.keys[terminal]
+                    self.condition.notify_all()
+                if not healthy or self.closed:
+                    self._discard(terminal)
+
+    def close(self):
+        """Closes idle sessions; sessions in use close when checked in."""
+        with self.condition:
+            self.closed = True
+            idle = list(self.idle)
+            for terminal in idle:
+                del self.keys[terminal]
+            self.idle.clear()
+            self.condition.notify_all()
+        for terminal in idle:
+            self._discard(terminal)
+
+
+FleetResult = collections.namedtuple(
+    'FleetResult', ['host', 'result', 'exception', 'elapsed'])
+
+
+class Fleet(object):
+    """Runs one job against many hosts concurrently.
+
+    Each host is handled on a bounded thread pool: a Terminal is built with
+    the remaining keyword arguments and passed to job(terminal), and the
+    Terminal is closed when the job returns.  Iterate over the Fleet to
+    receive a FleetResult for each host as soon as that host finishes:
+
+        fleet = pyvty.Fleet(hosts, job, workers=50, username=u, password=p)
+        for host, result, exception, elapsed in fleet:
+            ...
+
+    workers limits how many hosts are handled at once.
+    deadline limits the seconds spent on a single host: it becomes the
+    Terminal's deadline, so its waits raise PromptTimeout, holding the
+    partial output, once the time is up.  A job still running
+    abandon_grace seconds later, outside any wait, is reported with a
+    PromptTimeout of its own and its Terminal is closed underneath it.
+    Terminals are strict unless strict=False is given, so an idle
+    timeout or a closed session fails the host too.
+    cancel() stops the run from any thread: every host's current or next
+    wait raises PromptTimeout with reason 'cancelled'.
+    fail_fast stops the run after the first host that raises: hosts not yet
+    started are skipped and hosts still running are cancelled.
+    timings maps hosts to TimingProfile.as_dict() values from an earlier
+    run, used to seed each Terminal; after the run it holds what each
+    host's Terminal learned, ready to save for the next one.
+    host_metrics maps each host to the Metrics of its Terminals, including
+    hosts that failed to connect, and metrics sums them over every host,
+    with hosts and host_failures counters of its own:
+
+        pyvty.write_metrics('/var/lib/node_exporter/pyvty.prom', fleet.host_metrics)
+    """
+
+    def __init__(self, hosts, job, workers=32, deadline=None,
+            fail_fast=False, timings=None, **kwargs):
+        self.hosts = hosts
+        self.job = job
+        self.workers = workers
+        self.deadline = deadline
+        self.fail_fast = fail_fast
+        self.timings = timings if timings is not None else {}
+        self.kwargs = kwargs
+        self.kwargs.setdefault('strict', True)
+        self.token = CancelToken()
+        self.started = {}
+        self.terminals = {}
+        self.metrics = Metrics()
+        self.host_metrics = {}
+        self.metrics_lock = threading.Lock()
+
+    abandon_grace = 1.0
+
+    def __iter__(self):
+        return self.run()
+
+    def cancel(self):
+        """Cancels every host still waiting on or running its job."""
+        self.token.cancel()
+
+    def _run_host(self, host):
+        """Connects to one host and runs the job against it."""
+        start_time = time.time()
+        self.started[host] = start_time
+        terminal = None
+        kwargs = dict(self.kwargs)
+        kwargs['cancel'] = self.token
+        if self.deadline is not None:
+            kwargs['deadline'] = start_time + self.deadline
+        if host in self.timings:
+            kwargs['timing'] = dict(self.timings[host])
+        if self.token.cancelled:
+            raise PromptTimeout('Cancelled.', reason='cancelled')
+        metrics = kwargs['metrics'] = Metrics()
+        metrics.add('hosts')
+        try:
+            terminal = Terminal(host, **kwargs)
+            self.terminals[host] = terminal
+            return self.job(terminal)
+        except Exception:
+            metrics.add('host_failures')
+            raise
+        finally:
+            self.terminals.pop(host, None)
+            if terminal is not None:
+                self.timings[host] = terminal.timing.as_dict()
+                terminal.close()
+            with self.metrics_lock:
+                if host in self.host_metrics:
+                    self.host_metrics[host].merge(metrics)
+                else:
+                    self.host_metrics[host] = metrics
+                self.metrics.merge(metrics)
+
+    def _abandon(self, host):
+        """Closes the Terminal of a host that ran past its deadline."""
+        terminal = self.terminals.pop(host, None)
+        if terminal is not None:
+            try:
+                terminal.close()
+            except Exception:
+                pass
+
+    def run(self):
+        """Yields a FleetResult for each host in the order they finish."""
+        if self.token.cancelled:
+            self.token = CancelToken()
+        executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+        pending = {}
+        try:
+            for host in self.hosts:
+                future = executor.submit(self._run_host, host)
+                pending[future] = host
+            while pending:
+                wait_time = None
+                if self.deadline is not None:
+                    now = time.time()
+                    for future, host in list(pending.items()):
+                        if host not in self.started:
+                            continue
+                        remaining = (self.started[host] + self.deadline
+                            + self.abandon_grace - now)
+                        if remaining <= 0:
+                            del pending[future]
+                            self._abandon(host)
+                            error = PromptTimeout(
+                                'Host exceeded deadline of {0} seconds.'
+                                .format(self.deadline), reason='deadline')
+                            yield FleetResult(host, None, error, now - self.started[host])
+                            if self.fail_fast:
+                                return
+                        elif wait_time is None or remaining < wait_time:
+                            wait_time = remaining
+                    if not pending:
+                        break
+                    if wait_time is None:
+                        # Nothing running yet: poll for workers to start.
+                        wait_time = 0.05
+                done, not_done = concurrent.futures.wait(list(pending),
+                    timeout=wait_time,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    host = pending.pop(future)
+                    elapsed = time.time() - self.started.get(host, time.time())
+                    exception = future.exception()
+                    if exception is None:
+                        yield FleetResult(host, future.result(), None, elapsed)
+                    else:
+                        yield FleetResult(host, None, exception, elapsed)
+                        if self.fail_fast:
+                            return
+        finally:
+            # Running jobs stop at their next wait; the rest never start.
+            self.token.cancel()
+            for future in pending:
+                future.cancel()
+            for host in list(self.terminals):
+                self._abandon(host)
+            executor.shutdown(wait=False)
@@ -0,0 +1,795 @@
+#!/usr/bin/python3
+"""Simulated IOS-style network devices for exercising pyvty.
+
+A Device answers on SSH (a paramiko ServerInterface) and telnet with a
+small Cisco-like command line: user and enable modes, configuration mode
+with a running configuration that reflects what was pushed, paging with
+--More--, multi-line banners, and large canned outputs.  latency delays
+every reply and bandwidth throttles output in bytes per second, so slow
+devices can be imitated on one machine.
+
+From Python:
+
+    device = pyvty_sim.Device(hostname='sim1', latency=0.01)
+    ssh_port = device.serve_ssh()
+    telnet_port = device.serve_telnet()
+    ...
+    device.close()
+
+From the shell:
+
+    python3 pyvty_sim.py --ssh 2222 --telnet 2323 --latency 0.01
+
+Besides the usual show commands, 'show big N' prints N numbered lines.
+Files copied in over SCP or SFTP land in Device.files, and
+'copy flash:name running-config' applies one like a config session.
+"""
+
+import argparse
+import collections
+import random
+import re
+import socket
+import sys
+import threading
+import time
+
+import paramiko
+
+
+IAC = 255
+DONT = 254
+DO = 253
+WONT = 252
+WILL = 251
+SB = 250
+SE = 240
+ECHO = 1
+SGA = 3
+
+block_modes = {
+    'interface': 'config-if',
+    'router': 'config-router',
+    'line': 'config-line',
+    'vlan': 'config-vlan',
+    'route-map': 'config-route-map',
+    'policy-map': 'config-pmap',
+    'class-map': 'config-cmap',
+    }
+
+invalid_input = u"% Invalid input detected at '^' marker.\r\n"
+
+version_text = u"""Cisco IOS Software, C3750E Software (C3750E-UNIVERSALK9-M), Version 15.2(4)E10, RELEASE SOFTWARE (fc2)
+Technical Support: http://www.cisco.com/techsupport
+Copyright (c) 1986-2020 by Cisco Systems, Inc.
+Compiled Tue 31-Mar-20 22:35 by prod_rel_team
+
+ROM: Bootstrap program is C3750E boot loader
+BOOTLDR: C3750E Boot Loader (C3750X-HBOOT-M) Version 15.2(3r)E, RELEASE SOFTWARE (fc1)
+
+{0} uptime is 42 weeks, 3 days, 7 hours, 12 minutes
+System returned to ROM by power-on
+System image file is "flash:c3750e-universalk9-mz.152-4.E10.bin"
+
+cisco WS-C3750X-48P (PowerPC405) processor (revision W0) with 262144K bytes of memory.
+Processor board ID FDO1234X0YZ
+Last reset from power-on
+{1} Gigabit Ethernet interfaces
+The password-recovery mechanism is enabled.
+
+Configuration register is 0xF
+"""
+
+
+class Device(object):
+    """A simulated switch that can be served over SSH and telnet.
+
+    hostname, username and password set the prompt and the login;
+    enable_password defaults to password.  latency is the delay in
+    seconds before each reply and bandwidth, if set, limits output to that
+    many bytes per second.  page_length is the initial terminal length
+    (0 turns paging off).  motd is shown before the first prompt.
+    interfaces and mac_entries size the generated configuration and MAC
+    table, and outputs maps extra commands to the text they print.
+    files maps flash file names to their bytes.  stalls maps commands to
+    the seconds the device stays silent, echo included, before running
+    them, like a device too busy to answer.
+    """
+
+    def __init__(self, hostname='sim1', username='admin', password='admin',
+            enable_password=None, latency=0, bandwidth=None, page_length=24,
+            motd=None, interfaces=48, mac_entries=1000, outputs=None,
+            stalls=None):
+        self.hostname = hostname
+        self.username = username
+        self.password = password
+        self.enable_password = enable_password or password
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.page_length = page_length
+        self.motd = motd
+        self.interfaces = interfaces
+        self.mac_entries = mac_entries
+        self.outputs = dict(outputs or {})
+        self.stalls = dict(stalls or {})
+        self.lock = threading.Lock()
+        self.config = collections.OrderedDict()
+        self.config['version 15.2'] = []
+        self.config['service timestamps log datetime msec'] = []
+        self.config['hostname {0}'.format(hostname)] = []
+        for number in range(1, interfaces + 1):
+            self.config['interface GigabitEthernet1/0/{0}'.format(number)] = [
+                'switchport access vlan 10',
+                'switchport mode access',
+                'spanning-tree portfast',
+                ]
+        self.config['line vty 0 15'] = ['transport input ssh telnet']
+        self.files = {}
+        self.servers = []
+        self.host_key = None
+
+    def authenticate(self, username, password):
+        return username == self.username and password == self.password
+
+    def _expand(self, command, known):
+        """Returns the known command that command abbreviates, if any."""
+        words = command.split()
+        for candidate in known:
+            candidate_words = candidate.split()
+            if len(candidate_words) == len(words) and all(
+                    full.startswith(word) for word, full in zip(words, candidate_words)):
+                return candidate
+        return None
+
+    def output(self, command):
+        """Returns the text a show command prints, or None if invalid."""
+        command = command.strip()
+        if command in self.outputs:
+            return self.outputs[command]
+        match = re.match(r'sh(?:o|ow)? big (\d+)$', command)
+        if match:
+            return u''.join(u'line {0} of big output with some padding text\r\n'
+                .format(number) for number in range(int(match.group(1))))
+        generators = collections.OrderedDict([
+            ('show version', self._show_version),
+            ('show running-config', self.running_config),
+            ('show interfaces status', self._show_interfaces),
+            ('show mac address-table', self._show_mac),
+            ('show clock', self._show_clock),
+            ])
+        known = self._expand(command, list(generators) + list(self.outputs))
+        if known in self.outputs:
+            return self.outputs[known]
+        if known:
+            return generators[known]()
+        return None
+
+    def _show_version(self):
+        return version_text.format(self.hostname, self.interfaces)
+
+    def _show_interfaces(self):
+        lines = [u'Port      Name               Status       Vlan       Duplex  Speed Type']
+        for number in range(1, self.interfaces + 1):
+            lines.append(u'Gi1/0/{0:<4}                   connected    10         a-full a-1000 10/100/1000BaseTX'
+                .format(number))
+        return u'\r\n'.join(lines) + u'\r\n'
+
+    def _show_mac(self):
+        lines = [
+            u'          Mac Address Table',
+            u'-------------------------------------------',
+            u'',
+            u'Vlan    Mac Address       Type        Ports',
+            u'----    -----------       --------    -----',
+            ]
+        generator = random.Random(self.mac_entries)
+        for number in range(self.mac_entries):
+            mac = u'{0:04x}.{1:04x}.{2:04x}'.format(generator.getrandbits(16),
+                generator.getrandbits(16), number & 0xffff)
+            lines.append(u'  10    {0}    DYNAMIC     Gi1/0/{1}'.format(
+                mac, number % self.interfaces + 1))
+        lines.append(u'Total Mac Addresses for this criterion: {0}'.format(self.mac_entries))
+        return u'\r\n'.join(lines) + u'\r\n'
+
+    def _show_clock(self):
+        return time.strftime(u'*%H:%M:%S.000 UTC %a %b %d %Y\r\n', time.gmtime())
+
+    def running_config(self):
+        with self.lock:
+            lines = [u'!']
+            for line, children in self.config.items():
+                lines.append(line)
+                lines.extend(u' ' + child for child in children)
+                if children:
+                    lines.append(u'!')
+            lines.append(u'end')
+        text = u'\r\n'.join(lines) + u'\r\n'
+        return (u'Building configuration...\r\n\r\nCurrent configuration : {0} bytes\r\n'
+            .format(len(text)) + text)
+
+    def apply(self, line, block=None):
+        """Applies one configuration line, inside block if given.
+
+        Returns the block the line opens, None if it is a plain command,
+        or False if it is rejected.
+        """
+        words = line.split()
+        if not words:
+            return None
+        if words[0] in ('bad', 'invalid'):
+            return False
+        negate = words[0] == 'no'
+        if words[0] in block_modes or (negate and words[1:2] and words[1] in block_modes):
+            block = None
+        with self.lock:
+            if block is not None:
+                children = self.config.setdefault(block, [])
+                if negate:
+                    target = u' '.join(words[1:])
+                    children[:] = [child for child in children
+                        if child != target and not child.startswith(target + u' ')]
+                elif line.strip() not in children:
+                    children.append(line.strip())
+                return block
+            if negate:
+                target = u' '.join(words[1:])
+                for key in list(self.config):
+                    if key == target or key.startswith(target + u' '):
+                        del self.config[key]
+                return None
+            if words[0] == 'hostname' and len(words) > 1:
+                for key in list(self.config):
+                    if key.startswith(u'hostname '):
+                        del self.config[key]
+                self.hostname = words[1]
+            line = u' '.join(words)
+            self.config.setdefault(line, [])
+            if words[0] in block_modes:
+                return line
+            return None
+
+    def load(self, text):
+        """Applies configuration text as if typed.  Returns rejected lines."""
+        rejected = []
+        block = None
+        for line in text.splitlines():
+            command = line.strip()
+            if not command or command.startswith(u'!'):
+                continue
+            if command in (u'end', u'exit'):
+                block = None
+                continue
+            result = self.apply(command, block if line[:1].isspace() else None)
+            if result is False:
+                rejected.append(line)
+            elif result is not None:
+                block = result
+            elif not line[:1].isspace():
+                block = None
+        return rejected
+
+    def _listen(self, address, port):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((address, port))
+        listener.listen(1024)
+        self.servers.append(listener)
+        return listener
+
+    def serve_ssh(self, port=0, address='127.0.0.1'):
+        """Starts answering SSH on port and returns the port in use."""
+        if self.host_key is None:
+            self.host_key = paramiko.RSAKey.generate(2048)
+        listener = self._listen(address, port)
+
+        def accept():
+            while True:
+                try:
+                    connection, peer = listener.accept()
+                except OSError:
+                    return
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                transport = paramiko.Transport(connection)
+                transport.add_server_key(self.host_key)
+                transport.set_subsystem_handler('sftp', paramiko.SFTPServer, SFTPFiles)
+                try:
+                    transport.start_server(server=SSHServer(self))
+                except (paramiko.SSHException, EOFError):
+                    transport.close()
+
+        thread = threading.Thread(target=accept, name='pyvty-sim-ssh')
+        thread.daemon = True
+        thread.start()
+        return listener.getsockname()[1]
+
+    def serve_telnet(self, port=0, address='127.0.0.1'):
+        """Starts answering telnet on port and returns the port in use."""
+        listener = self._listen(address, port)
+
+        def accept():
+            while True:
+                try:
+                    connection, peer = listener.accept()
+                except OSError:
+                    return
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                session = CLISession(self, TelnetStream(connection))
+                thread = threading.Thread(target=session.run_telnet,
+                    name='pyvty-sim-telnet-session')
+                thread.daemon = True
+                thread.start()
+
+        thread = threading.Thread(target=accept, name='pyvty-sim-telnet')
+        thread.daemon = True
+        thread.start()
+        return listener.getsockname()[1]
+
+    def close(self):
+        """Stops accepting connections."""
+        for listener in self.servers:
+            try:
+                listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            listener.close()
+        self.servers = []
+
+
+class ChannelStream(object):
+    """Byte stream over a paramiko channel."""
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def recv(self):
+        return self.channel.recv(4096)
+
+    def send(self, data):
+        self.channel.sendall(data)
+
+    def close(self):
+        self.channel.close()
+
+
+class TelnetStream(object):
+    """Byte stream over a telnet socket with option negotiation removed."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.state = None
+        self.connection.sendall(bytes([IAC, WILL, ECHO, IAC, WILL, SGA]))
+
+    def recv(self):
+        output = bytearray()
+        while not output:
+            data = self.connection.recv(4096)
+            if not data:
+                return data
+            self._filter(data, output)
+        return bytes(output)
+
+    def _filter(self, data, output):
+        for byte in data:
+            if self.state is None:
+                if byte == IAC:
+                    self.state = IAC
+                else:
+                    output.append(byte)
+            elif self.state == IAC:
+                if byte == IAC:
+                    output.append(byte)
+                    self.state = None
+                elif byte in (DO, DONT, WILL, WONT):
+                    self.state = DO
+                elif byte == SB:
+                    self.state = SB
+                else:
+                    self.state = None
+            elif self.state == DO:
+                self.state = None
+            elif self.state == SB:
+                if byte == IAC:
+                    self.state = SE
+            elif self.state == SE:
+                self.state = None if byte == SE else SB
+
+    def send(self, data):
+        self.connection.sendall(data.replace(b'\xff', b'\xff\xff'))
+
+    def close(self):
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.connection.close()
+
+
+class SSHServer(paramiko.ServerInterface):
+    """Accepts password logins and runs a CLISession per shell."""
+
+    def __init__(self, device):
+        self.device = device
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if self.device.authenticate(username, password):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height,
+            pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        session = CLISession(self.device, ChannelStream(channel))
+        thread = threading.Thread(target=session.run, name='pyvty-sim-ssh-session')
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        session = CLISession(self.device, ChannelStream(channel))
+        thread = threading.Thread(target=session.run_exec,
+            args=(command.decode('utf-8', 'replace'),), name='pyvty-sim-exec')
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class SFTPHandle(paramiko.SFTPHandle):
+    """An upload held in memory until it is closed into Device.files."""
+
+    def __init__(self, device, path, flags):
+        paramiko.SFTPHandle.__init__(self, flags)
+        self.device = device
+        self.path = path
+        self.data = bytearray()
+
+    def write(self, offset, data):
+        self.data[offset:offset + len(data)] = data
+        return paramiko.SFTP_OK
+
+    def close(self):
+        self.device.files[self.path] = bytes(self.data)
+        paramiko.SFTPHandle.close(self)
+
+
+class SFTPFiles(paramiko.SFTPServerInterface):
+    """SFTP server over Device.files; paths are used as flash names."""
+
+    def __init__(self, server, *args, **kwargs):
+        paramiko.SFTPServerInterface.__init__(self, server, *args, **kwargs)
+        self.device = server.device
+
+    def open(self, path, flags, attr):
+        return SFTPHandle(self.device, path, flags)
+
+    def stat(self, path):
+        if path not in self.device.files:
+            return paramiko.SFTP_NO_SUCH_FILE
+        attributes = paramiko.SFTPAttributes()
+        attributes.st_size = len(self.device.files[path])
+        attributes.st_mode = 0o100644
+        return attributes
+
+    lstat = stat
+
+    def remove(self, path):
+        if self.device.files.pop(path, None) is None:
+            return paramiko.SFTP_NO_SUCH_FILE
+        return paramiko.SFTP_OK
+
+
+class CLISession(object):
+    """One login session on a Device: reads command lines, writes replies."""
+
+    def __init__(self, device, stream):
+        self.device = device
+        self.stream = stream
+        self.pending = b''
+        self.skip_newline = False
+        self.mode = 'exec'
+        self.block = None
+        self.banner = None
+        self.page_length = device.page_length
+
+    def prompt(self):
+        hostname = self.device.hostname
+        if self.mode == 'exec':
+            return hostname + u'>'
+        if self.mode == 'enable':
+            return hostname + u'#'
+        return u'{0}({1})#'.format(hostname, self.mode)
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        bandwidth = self.device.bandwidth
+        if not bandwidth:
+            self.stream.send(data)
+            return
+        size = max(1, int(bandwidth / 100))
+        for index in range(0, len(data), size):
+            self.stream.send(data[index:index + size])
+            time.sleep(len(data[index:index + size]) / float(bandwidth))
+
+    def _fill(self):
+        data = self.stream.recv()
+        if not data:
+            raise EOFError('client closed the session')
+        self.pending += data
+
+    def read_key(self):
+        """Returns the next byte of input as a one character string."""
+        while True:
+            if self.skip_newline and self.pending[:1] in (b'\n', b'\0'):
+                self.pending = self.pending[1:]
+            if self.pending:
+                self.skip_newline = False
+                key, self.pending = self.pending[:1], self.pending[1:]
+                if key == b'\r':
+                    self.skip_newline = True
+                return key.decode('latin-1')
+            self._fill()
+
+    def read_line(self, echo=True):
+        """Returns the next line of input without its line ending."""
+        while True:
+            if self.skip_newline and self.pending[:1] in (b'\n', b'\0'):
+                self.pending = self.pending[1:]
+                self.skip_newline = False
+            match = re.search(b'[\r\n]', self.pending)
+            if match:
+                line = self.pending[:match.start()].replace(b'\0', b'')
+                self.skip_newline = match.group() == b'\r'
+                self.pending = self.pending[match.end():]
+                line = line.decode('utf-8', 'replace')
+                if line.strip() in self.device.stalls:
+                    time.sleep(self.device.stalls[line.strip()])
+                if echo:
+                    self.write(line + u'\r\n')
+                else:
+                    self.write(u'\r\n')
+                return line
+            if self.pending:
+                self.skip_newline = False
+            self._fill()
+
+    def page(self, text):
+        """Writes text, pausing at --More-- every page_length lines."""
+        lines = text.split(u'\r\n')
+        if lines and lines[-1] == u'':
+            lines.pop()
+        if not self.page_length or len(lines) <= self.page_length:
+            self.write(text)
+            return
+        index = 0
+        count = self.page_length - 1
+        while index < len(lines):
+            self.write(u''.join(line + u'\r\n' for line in lines[index:index + count]))
+            index += count
+            if index >= len(lines):
+                break
+            self.write(u' --More-- ')
+            key = self.read_key()
+            self.write(u'\b' * 9 + u' ' * 9 + u'\b' * 9)
+            if key == u' ':
+                count = self.page_length - 1
+            elif key in (u'\r', u'\n'):
+                count = 1
+            else:
+                break
+
+    def login(self):
+        """Asks for username and password; returns True once they match."""
+        self.write(u'\r\nUser Access Verification\r\n')
+        for attempt in range(3):
+            self.write(u'\r\nUsername: ')
+            username = self.read_line()
+            self.write(u'Password: ')
+            password = self.read_line(echo=False)
+            if self.device.authenticate(username, password):
+                return True
+            self.write(u'% Authentication failed\r\n')
+        return False
+
+    def run_telnet(self):
+        try:
+            if self.login():
+                self.run()
+                return
+        except (EOFError, OSError):
+            pass
+        self.stream.close()
+
+    def run(self):
+        """Serves the command line until the client exits or disconnects."""
+        try:
+            if self.device.motd:
+                self.write(u'\r\n' + self.device.motd.replace(u'\n', u'\r\n'))
+            self.write(u'\r\n' + self.prompt())
+            while True:
+                line = self.read_line()
+                if self.device.latency:
+                    time.sleep(self.device.latency)
+                if not self.handle(line):
+                    break
+                if not self.banner:
+                    self.write(self.prompt())
+        except (EOFError, OSError, paramiko.SSHException):
+            pass
+        finally:
+            self.stream.close()
+
+    def run_scp(self, path):
+        """Receives one file as the sink of 'scp -t path'."""
+        channel = self.stream.channel
+        channel.sendall(b'\0')
+        header = b''
+        while not header.endswith(b'\n'):
+            header += channel.recv(1)
+        mode, size, name = header.decode('utf-8').split(None, 2)
+        channel.sendall(b'\0')
+        data = bytearray()
+        while len(data) < int(size) + 1:
+            chunk = channel.recv(65536)
+            if not chunk:
+                raise EOFError('scp source closed early')
+            data += chunk
+        self.device.files[path] = bytes(data[:int(size)])
+        channel.sendall(b'\0')
+        channel.send_exit_status(0)
+
+    def run_exec(self, command):
+        """Runs one command for an SSH exec request and closes the channel."""
+        try:
+            if command.startswith(u'scp -t '):
+                self.run_scp(command[7:].strip())
+                return
+            # paramiko acknowledges the exec request only after this thread
+            # starts, and a channel closed before that fails the request.
+            time.sleep(max(self.device.latency, 0.01))
+            output = self.device.output(command)
+            if output is None:
+                self.write(invalid_input)
+            else:
+                self.write(output)
+            self.stream.channel.send_exit_status(0 if output is not None else 1)
+        except (EOFError, OSError, paramiko.SSHException):
+            pass
+        finally:
+            self.stream.close()
+
+    def handle(self, line):
+        """Acts on one command line.  Returns False to end the session."""
+        command = line.strip()
+        words = command.split()
+        if self.banner:
+            if self.banner in line:
+                self.banner = None
+            return True
+        if not words:
+            return True
+        if self.mode in ('exec', 'enable'):
+            return self.handle_exec(command, words)
+        return self.handle_config(command, words)
+
+    def handle_exec(self, command, words):
+        if u'enable'.startswith(words[0]) and len(words[0]) >= 2 and len(words) == 1:
+            if self.mode == 'exec':
+                self.write(u'Password: ')
+                if self.read_line(echo=False) == self.device.enable_password:
+                    self.mode = 'enable'
+                else:
+                    self.write(u'% Access denied\r\n\r\n')
+        elif command == 'disable':
+            self.mode = 'exec'
+        elif command in ('exit', 'quit', 'logout'):
+            return False
+        elif len(words) == 3 and u'terminal'.startswith(words[0]) \
+                and u'length'.startswith(words[1]) and words[2].isdigit():
+            self.page_length = int(words[2])
+        elif words[0] == 'copy' and len(words) == 3 and words[2] == 'running-config' \
+                and self.mode == 'enable':
+            self.write(u'Destination filename [running-config]? ')
+            self.read_line()
+            data = self.device.files.get(words[1])
+            if data is None:
+                self.write(u'%Error opening {0} (No such file or directory)\r\n'
+                    .format(words[1]))
+            else:
+                for line in self.device.load(data.decode('utf-8', 'replace')):
+                    self.write(line.strip() + u'\r\n' + invalid_input)
+                self.write(u'{0} bytes copied in 0.012 secs\r\n'.format(len(data)))
+        elif words[:2] == ['delete', '/force'] and len(words) == 3:
+            if self.device.files.pop(words[2], None) is None:
+                self.write(u'%Error deleting {0} (No such file or directory)\r\n'
+                    .format(words[2]))
+        elif len(words) == 2 and u'configure'.startswith(words[0]) \
+                and len(words[0]) >= 4 and u'terminal'.startswith(words[1]) \
+                and self.mode == 'enable':
+            self.write(u'Enter configuration commands, one per line.  End with CNTL/Z.\r\n')
+            self.mode = 'config'
+        else:
+            output = self.device.output(command)
+            if output is None:
+                self.write(invalid_input)
+            else:
+                self.page(output)
+        return True
+
+    def handle_config(self, command, words):
+        if command == 'end':
+            self.mode = 'enable'
+            self.block = None
+        elif command == 'exit':
+            if self.block is None:
+                self.mode = 'enable'
+            else:
+                self.mode = 'config'
+                self.block = None
+        elif words[0] == 'do' and len(words) > 1:
+            output = self.device.output(u' '.join(words[1:]))
+            self.write(invalid_input if output is None else output)
+        elif words[0] == 'banner' and len(words) >= 3:
+            delimiter = words[2][0]
+            if len(command.split(delimiter)) < 3:
+                self.banner = delimiter
+                self.write(u"Enter TEXT message.  End with the character '{0}'.\r\n"
+                    .format(delimiter))
+        else:
+            block = self.device.apply(command, self.block)
+            if block is False:
+                self.write(invalid_input)
+            elif block is not None:
+                self.block = block
+                self.mode = block_modes.get(block.split()[0], 'config')
+            elif self.block is not None and words[0] in block_modes:
+                self.block = None
+                self.mode = 'config'
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--ssh', type=int, default=2222, help='SSH port, 0 for any')
+    parser.add_argument('--telnet', type=int, default=2323, help='telnet port, 0 for any')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--hostname', default='sim1')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--bandwidth', type=int, default=None)
+    parser.add_argument('--page-length', type=int, default=24)
+    parser.add_argument('--motd', default=None)
+    parser.add_argument('--interfaces', type=int, default=48)
+    parser.add_argument('--mac-entries', type=int, default=1000)
+    parser.add_argument('--stall', action='append', default=[],
+        metavar='COMMAND=SECONDS', help='stay silent that long before COMMAND')
+    args = parser.parse_args()
+    stalls = {}
+    for stall in args.stall:
+        command, seconds = stall.rsplit('=', 1)
+        stalls[command] = float(seconds)
+    device = Device(hostname=args.hostname, username=args.username,
+        password=args.password, latency=args.latency, bandwidth=args.bandwidth,
+        page_length=args.page_length, motd=args.motd, interfaces=args.interfaces,
+        mac_entries=args.mac_entries, stalls=stalls)
+    print('ssh {0}'.format(device.serve_ssh(args.ssh, args.address)))
+    print('telnet {0}'.format(device.serve_telnet(args.telnet, args.address)))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        device.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+#!/usr/bin/python3
+"""Local daemon that keeps pyvty sessions open for scripts to reuse.
+
+pyvtyd holds authenticated, enabled sessions in a TerminalPool and serves
+them on a Unix socket, much like SSH ControlMaster but for telnet as
+well.  Scripts and cron jobs attach with a RemoteTerminal, which has the
+everyday Terminal methods, and skip the connect and login entirely when
+a warm session to the device is waiting:
+
+    python3 pyvtyd.py --idle-ttl 900 &
+
+    import pyvtyd
+    with pyvtyd.RemoteTerminal('10.0.0.1', username=u, password=p) as term:
+        term.send('show version')
+
+open_terminal() returns a RemoteTerminal when the daemon is running and
+a plain pyvty.Terminal otherwise, so scripts work either way.
+
+The protocol is one JSON object per line in each direction.  A client
+first sends {"op": "open", "host": ..., "port": ..., "protocol": ...,
+"options": {...}}; the daemon checks a session out for that client and
+holds it until the client disconnects, so mode changes last for the
+script just as on a direct Terminal.  Then {"op": "send", "args": [...],
+"kwargs": {...}} calls the Terminal method of that name and is answered
+with {"result": ...} or {"error": kind, "message": ..., "output": ...}.  send_iter is
+answered with one {"line": ...} per line before its result.
+{"op": "status"} describes the pool and needs no session.
+
+Anyone who can connect to the socket can drive the sessions, so it is
+created readable and writable by its owner only.
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+
+import pyvty
+
+log = logging.getLogger('pyvty.daemon')
+
+default_socket = os.environ.get('PYVTYD_SOCKET',
+    os.path.expanduser('~/.pyvtyd.sock'))
+
+# Terminal methods a client may call.
+methods = ('send', 'send_iter', 'send_batch', 'configure', 'push_config',
+    'deploy_config', 'running_config', 'learn_prompt')
+
+
+def _encode_result(result):
+    if isinstance(result, pyvty.ConfigBlock):
+        return str(result)
+    return result
+
+
+def _error_kind(exception):
+    if isinstance(exception, pyvty.ConnectionLost):
+        return 'lost'
+    if isinstance(exception, socket.timeout):
+        return 'timeout'
+    if isinstance(exception, (socket.error, EOFError)):
+        return 'socket'
+    return 'warning'
+
+
+class SessionHandler(socketserver.StreamRequestHandler):
+    """Serves one client connection and the session it has open."""
+
+    def reply(self, **message):
+        self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+    def handle(self):
+        pool = self.server.pool
+        terminal = None
+        healthy = True
+        try:
+            for line in self.rfile:
+                request = json.loads(line.decode('utf-8'))
+                operation = request.get('op')
+                try:
+                    if operation == 'status':
+                        self.reply(result=self.server.status())
+                    elif operation == 'open':
+                        if terminal is not None:
+                            raise UserWarning('A session is already open.')
+                        terminal = pool.checkout(request['host'],
+                            request.get('port'), request.get('protocol'),
+                            **request.get('options', {}))
+                        self.reply(result={
+                            'host': terminal.host,
+                            'hostname': terminal.hostname,
+                            'platform': terminal.platform,
+                            'prompt': terminal.prompt,
+                            })
+                    elif terminal is None:
+                        raise UserWarning('No session is open.')
+                    elif operation not in methods:
+                        raise UserWarning('Unknown operation {0!r}.'.format(operation))
+                    elif operation == 'send_iter':
+                        for output in terminal.send_iter(*request.get('args', ()),
+                                **request.get('kwargs', {})):
+                            self.reply(line=output)
+                        self.reply(result=None)
+                    else:
+                        result = getattr(terminal, operation)(
+                            *request.get('args', ()), **request.get('kwargs', {}))
+                        self.reply(result=_encode_result(result))
+                except Exception as exception:
+                    # Anything but a bad request leaves the session in
+                    # an unknown state, so it is not handed out again.
+                    if not isinstance(exception, (UserWarning, TypeError, ValueError)):
+                        healthy = False
+                    log.debug('request %r failed: %s', operation, exception)
+                    self.reply(error=_error_kind(exception), message=str(exception),
+                        output=getattr(exception, 'output', None),
+                        reason=getattr(exception, 'reason', None))
+        except (socket.error, ValueError) as exception:
+            log.debug('client connection lost: %s', exception)
+        finally:
+            if terminal is not None:
+                if healthy:
+                    healthy = self.server.reset(terminal)
+                pool.checkin(terminal, discard=not healthy)
+
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves a TerminalPool on a Unix socket, one thread per client.
+
+    Keyword arguments configure the TerminalPool, such as idle_ttl,
+    max_per_host or timeout for every Terminal.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path=default_socket, **kwargs):
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, SessionHandler)
+        finally:
+            os.umask(umask)
+        self.pool = pyvty.TerminalPool(**kwargs)
+
+    def status(self):
+        with self.pool.condition:
+            hosts = sorted(set(key[0] for key in self.pool.keys.values()))
+            return {
+                'sessions': len(self.pool.keys),
+                'idle': len(self.pool.idle),
+                'hosts': hosts,
+                }
+
+    def reset(self, terminal):
+        """Leaves configuration mode if a client left the session there.
+
+        Returns False if the session no longer answers.
+        """
+        try:
+            if u'(config' in (terminal.last_regex_match or u''):
+                for command in terminal.driver.config_exit:
+                    terminal.send(command)
+            return True
+        except pyvty.exceptions as exception:
+            log.debug('session reset failed: %s', exception)
+            return False
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self.pool.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class RemoteTerminal(object):
+    """A Terminal whose session lives in pyvtyd.
+
+    Takes the same host, port, protocol and keyword arguments as
+    pyvty.Terminal; sessions are shared between clients that give the
+    same host, port, protocol, platform, username and password.  Failures
+    are raised as PromptTimeout, ConnectionLost, socket.error or
+    UserWarning, all in pyvty.exceptions.  Closing a RemoteTerminal hands its session back to
+    the daemon rather than logging out.
+    """
+
+    def __init__(self, host, port=None, protocol=None, socket_path=None, **kwargs):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(socket_path or default_socket)
+        self.file = self.socket.makefile('rb')
+        info = self._call('open', host=host, port=port, protocol=protocol,
+            options=kwargs)
+        self.host = info['host']
+        self.hostname = info['hostname']
+        self.platform = info['platform']
+        self.prompt = info['prompt']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _request(self, operation, **request):
+        request['op'] = operation
+        self.socket.sendall(json.dumps(request).encode('utf-8') + b'\n')
+
+    def _reply(self):
+        line = self.file.readline()
+        if not line:
+            raise socket.error('pyvtyd closed the connection.')
+        reply = json.loads(line.decode('utf-8'))
+        if 'error' in reply:
+            if reply['error'] == 'lost':
+                raise pyvty.ConnectionLost(reply['message'], reply['output'] or u'')
+            if reply['error'] == 'timeout':
+                raise pyvty.PromptTimeout(reply['message'], reply['output'] or u'',
+                    reply['reason'] or 'idle')
+            if reply['error'] == 'socket':
+                raise socket.error(reply['message'])
+            raise UserWarning(reply['message'])
+        return reply
+
+    def _call(self, operation, **request):
+        self._request(operation, **request)
+        return self._reply()['result']
+
+    def _method(self, operation, *args, **kwargs):
+        return self._call(operation, args=args, kwargs=kwargs)
+
+    def send(self, command, prompt=None, timeout=None, deadline=None):
+        return self._method('send', command, prompt=prompt, timeout=timeout,
+            deadline=deadline)
+
+    def send_iter(self, command, prompt=None, timeout=None):
+        self._request('send_iter', args=[command],
+            kwargs={'prompt': prompt, 'timeout': timeout})
+        while True:
+            reply = self._reply()
+            if 'line' not in reply:
+                return
+            try:
+                yield reply['line']
+            except GeneratorExit:
+                self._drain()
+                raise
+
+    def _drain(self):
+        """Reads past the replies left by a send_iter the caller abandoned.
+
+        The connection is closed if that fails, so no later call can read
+        those replies as its own.
+        """
+        try:
+            while True:
+                line = self.file.readline()
+                if not line:
+                    break
+                if 'line' not in json.loads(line.decode('utf-8')):
+                    return
+        except (socket.error, ValueError) as exception:
+            log.debug('reading past send_iter replies failed: %s', exception)
+        self.close()
+
+    def send_batch(self, commands, **kwargs):
+        return [pyvty.BatchResult(*result)
+            for result in self._method('send_batch', list(commands), **kwargs)]
+
+    def configure(self, lines, **kwargs):
+        return [pyvty.BatchResult(*result)
+            for result in self._method('configure', list(lines), **kwargs)]
+
+    def push_config(self, desired, **kwargs):
+        if isinstance(desired, pyvty.ConfigBlock):
+            desired = str(desired)
+        elif not isinstance(desired, str):
+            desired = list(desired)
+        return [pyvty.BatchResult(*result)
+            for result in self._method('push_config', desired, **kwargs)]
+
+    def deploy_config(self, config, **kwargs):
+        if isinstance(config, pyvty.ConfigBlock):
+            config = str(config)
+        elif not isinstance(config, str):
+            config = list(config)
+        return pyvty.DeployResult(*self._method('deploy_config', config, **kwargs))
+
+    def running_config(self, section=None):
+        return pyvty.parse_config(self._method('running_config', section))
+
+    def learn_prompt(self, text=None):
+        self._method('learn_prompt', text)
+
+    def status(self):
+        """Returns the daemon's session counts and connected hosts."""
+        return self._call('status')
+
+    def close(self):
+        if self.socket is not None:
+            self.file.close()
+            self.socket.close()
+            self.socket = None
+
+
+def open_terminal(host, port=None, protocol=None, socket_path=None, **kwargs):
+    """Returns a RemoteTerminal if pyvtyd is listening, else a Terminal."""
+    path = socket_path or default_socket
+    if os.path.exists(path):
+        try:
+            return RemoteTerminal(host, port, protocol, socket_path=path, **kwargs)
+        except socket.error as exception:
+            if isinstance(exception, socket.timeout):
+                raise
+            log.debug('pyvtyd unavailable at %s: %s', path, exception)
+    return pyvty.Terminal(host, port=port, protocol=protocol, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--socket', default=default_socket)
+    parser.add_argument('--max-size', type=int, default=64,
+        help='sessions held open in all')
+    parser.add_argument('--max-per-host', type=int, default=2)
+    parser.add_argument('--idle-ttl', type=float, default=900,
+        help='seconds an unused session stays open')
+    parser.add_argument('--keepalive', type=float, default=60,
+        help='seconds between prompt probes of idle sessions')
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    daemon = Daemon(args.socket, max_size=args.max_size,
+        max_per_host=args.max_per_host, idle_ttl=args.idle_ttl,
+        keepalive=args.keepalive)
+    print('listening on {0}'.format(args.socket))
+    sys.stdout.flush()
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+
+
+if __name__ == '__main__':
+    main()